@@ -0,0 +1,70 @@
+'''
+micro-benchmark for utils.bencoding
+
+times decoding and encoding a large generated .torrent (hundreds of
+thousands of pieces, thousands of files) and a dictionary-mode tracker
+response with thousands of peers - any .torrent files passed on the
+command line are timed as well
+
+usage: python benchmarks/bencode_bench.py [file.torrent ...]
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from utils.bencoding import Decoder, Encoder
+
+def make_torrent(num_pieces: int = 300000, num_files: int = 5000) -> bytes:
+    files = [{b'length' : 1 << 20, b'path' : [b'dir%d' % (i // 100), b'file%d.bin' % i]}
+             for i in range(num_files)]
+
+    info = {b'files' : files,
+            b'name' : b'benchmark',
+            b'piece length' : 1 << 16,
+            b'pieces' : os.urandom(20 * num_pieces)}
+
+    return Encoder().encode({b'announce' : b'http://127.0.0.1:6969/announce',
+                             b'info' : info})
+
+def make_tracker_response(num_peers: int = 5000) -> bytes:
+    peers = [{b'ip' : b'10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+              b'peer id' : os.urandom(20),
+              b'port' : 6881 + i % 1000}
+             for i in range(num_peers)]
+
+    return Encoder().encode({b'interval' : 1800, b'peers' : peers})
+
+def time_it(func, rounds: int) -> float:
+    best = float('inf')
+
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+def bench(name: str, data: bytes, rounds: int = 5):
+    value = Decoder(data).decode()
+
+    decode_time = time_it(lambda: Decoder(data).decode(), rounds)
+    strict_time = time_it(lambda: Decoder(data, strict=True).decode(), rounds)
+    encode_time = time_it(lambda: Encoder().encode(value), rounds)
+
+    size = len(data) / (1 << 20)
+
+    print("%s (%.1f MiB)" % (name, size))
+    print("  decode:        %8.2f ms  (%.0f MiB/s)" % (decode_time * 1000, size / decode_time))
+    print("  decode strict: %8.2f ms  (%.0f MiB/s)" % (strict_time * 1000, size / strict_time))
+    print("  encode:        %8.2f ms  (%.0f MiB/s)" % (encode_time * 1000, size / encode_time))
+
+if __name__ == "__main__":
+    bench("generated torrent", make_torrent())
+    bench("dictionary-mode tracker response", make_tracker_response())
+
+    for path in sys.argv[1:]:
+        with open(path, 'rb') as file:
+            bench(path, file.read())
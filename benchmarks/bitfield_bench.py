@@ -0,0 +1,115 @@
+'''
+micro-benchmark for utils.bitfield against bitstring, timing
+what the client does with bitfields - reading one off the wire,
+setting pieces as they complete while checking if everything is
+done, looking bits up while picking, and listing the set bits
+
+bitstring is only needed for the comparison
+
+usage: python benchmarks/bitfield_bench.py [number of pieces]
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from utils.bitfield import Bitfield
+
+try:
+    import bitstring
+except ImportError:
+    bitstring = None
+
+def time_it(func, rounds: int = 5) -> float:
+    best = float('inf')
+
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+def bitfield_cases(num_pieces: int, wire: bytes) -> dict:
+    def from_wire():
+        Bitfield.from_bytes(wire, num_pieces)
+
+    def complete_all():
+        completed = Bitfield(num_pieces)
+
+        for index in range(num_pieces):
+            completed.set(index)
+            completed.all()
+
+    peer = Bitfield.from_bytes(wire, num_pieces)
+
+    def lookups():
+        for index in range(num_pieces):
+            peer[index]
+
+    def set_bits():
+        for _ in peer.indices():
+            pass
+
+    return {'from wire' : from_wire,
+            'set + all() per piece' : complete_all,
+            'lookups' : lookups,
+            'iterate set bits' : set_bits,
+            'to wire' : peer.tobytes}
+
+def bitstring_cases(num_pieces: int, wire: bytes) -> dict:
+    def from_wire():
+        # what handle_bitfield used to do
+        bits = bitstring.BitArray(wire)
+        empty = bitstring.BitArray(num_pieces)
+        split = min(num_pieces, bits.len)
+        bits[:split] + empty[split:]
+
+    def complete_all():
+        completed = bitstring.BitArray(num_pieces)
+
+        for index in range(num_pieces):
+            completed.set(1, index)
+            completed.all(True)
+
+    peer = bitstring.BitArray(bytes=wire, length=num_pieces)
+
+    def lookups():
+        for index in range(num_pieces):
+            peer[index]
+
+    def set_bits():
+        for _ in peer.findall('0b1'):
+            pass
+
+    return {'from wire' : from_wire,
+            'set + all() per piece' : complete_all,
+            'lookups' : lookups,
+            'iterate set bits' : set_bits,
+            'to wire' : peer.tobytes}
+
+if __name__ == "__main__":
+    num_pieces = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+    # peer that has about half the pieces
+    wire = bytearray(os.urandom((num_pieces + 7) // 8))
+    spare = len(wire) * 8 - num_pieces
+    wire[-1] &= (0xff << spare) & 0xff
+    wire = bytes(wire)
+
+    ours = bitfield_cases(num_pieces, wire)
+    theirs = bitstring_cases(num_pieces, wire) if bitstring is not None else {}
+
+    print("%d pieces" % num_pieces)
+
+    for name, func in ours.items():
+        ours_time = time_it(func)
+
+        if name in theirs:
+            theirs_time = time_it(theirs[name])
+            print("  %-22s %9.3f ms   bitstring %9.3f ms   (%.1fx)"
+                  % (name, ours_time * 1000, theirs_time * 1000, theirs_time / ours_time))
+        else:
+            print("  %-22s %9.3f ms" % (name, ours_time * 1000))
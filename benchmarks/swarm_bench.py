@@ -0,0 +1,340 @@
+'''
+loopback swarm benchmark - downloads a generated torrent from local
+seeders through the real MetaInfo -> Tracker -> PeerFactory pipeline
+and reports how it went
+
+a stand-in HTTP tracker and the seeders run in a separate process by
+default (so only the downloading side's CPU time is counted), or in
+the same process with --in-process. seeders serve from memory and can
+add latency to every block they send, plus an extra retransmission
+delay on a fraction of them to act like packet loss
+
+reports MB/s, CPU seconds per GB, peak RSS and time to first byte
+
+usage: python benchmarks/swarm_bench.py --size 200 --piece-length 256 --seeders 4
+'''
+
+import argparse
+import hashlib
+import os
+import random
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from metainfo import MetaInfo
+from tracker import Tracker
+from connection import PeerFactory
+from utils.bencoding import Encoder
+from twisted.internet import reactor, protocol, task
+from twisted.web import server, resource as web_resource
+
+# extra delay for a block that's "lost", roughly a minimum TCP retransmission timeout
+RETRANSMIT_DELAY = 0.2
+
+def make_torrent(directory: str, size: int, piece_length: int, num_files: int, tracker_port: int) -> str:
+    '''
+    write random data and a torrent for it into directory,
+    returns the path of the torrent
+    '''
+
+    data = random.Random(1).randbytes(size)
+
+    info = {}
+
+    if num_files > 1:
+        file_size = size // num_files
+        lengths = [file_size] * (num_files - 1) + [size - file_size * (num_files - 1)]
+        info[b'files'] = [{b'length' : length, b'path' : [b'file%d.bin' % index]}
+                          for index, length in enumerate(lengths)]
+    else:
+        info[b'length'] = size
+
+    info[b'name'] = b'bench'
+    info[b'piece length'] = piece_length
+    info[b'pieces'] = b''.join(hashlib.sha1(data[start:start + piece_length]).digest()
+                               for start in range(0, size, piece_length))
+
+    torrent = {b'announce' : b'http://127.0.0.1:%d/announce' % tracker_port, b'info' : info}
+    encoded_info = Encoder().encode(info)
+
+    with open(os.path.join(directory, 'data.bin'), 'wb') as file:
+        file.write(data)
+
+    with open(os.path.join(directory, 'info_hash'), 'wb') as file:
+        file.write(hashlib.sha1(encoded_info).digest())
+
+    path = os.path.join(directory, 'bench.torrent')
+
+    with open(path, 'wb') as file:
+        file.write(Encoder().encode(torrent))
+
+    return path
+
+class SeederProtocol(protocol.Protocol):
+    '''
+    bare minimum seeder - handshake, full bitfield, unchoke, and
+    a piece message for every request
+    '''
+
+    def connectionMade(self):
+        self.buffer = bytearray()
+        self.have_handshaked = False
+
+    def dataReceived(self, data: bytes):
+        self.buffer += data
+
+        if not self.have_handshaked:
+            if len(self.buffer) < 68:
+                return
+
+            del self.buffer[:68]
+            self.have_handshaked = True
+            self.__start()
+
+        while len(self.buffer) >= 4:
+            length = struct.unpack_from('>I', self.buffer)[0]
+
+            if len(self.buffer) < 4 + length:
+                return
+
+            if length == 13 and self.buffer[4] == 6:
+                self.__send_block(*struct.unpack_from('>III', self.buffer, 5))
+
+            del self.buffer[:4 + length]
+
+    def __start(self):
+        factory = self.factory
+        peer_id = b'-BE0001-%012d' % random.randint(0, 10**11)
+
+        self.transport.write(struct.pack('>B19s8x20s20s', 19, b'BitTorrent protocol',
+                                         factory.info_hash, peer_id))
+
+        bitfield = bytearray(b'\xff' * ((factory.num_pieces + 7) // 8))
+        spare = len(bitfield) * 8 - factory.num_pieces
+        bitfield[-1] &= (0xff << spare) & 0xff
+
+        self.transport.write(struct.pack('>IB', 1 + len(bitfield), 5) + bytes(bitfield))
+        self.transport.write(struct.pack('>IB', 1, 1))
+
+    def __send_block(self, index: int, begin: int, length: int):
+        factory = self.factory
+        start = index * factory.piece_length + begin
+        block = factory.data[start:start + length]
+
+        message = struct.pack('>IBII', 9 + len(block), 7, index, begin) + block
+        delay = factory.latency
+
+        if factory.loss > 0 and random.random() < factory.loss:
+            delay += RETRANSMIT_DELAY
+
+        if delay > 0:
+            reactor.callLater(delay, self.__write, message)
+        else:
+            self.transport.write(message)
+
+    def __write(self, message: bytes):
+        if self.transport.connected:
+            self.transport.write(message)
+
+class SeederFactory(protocol.Factory):
+    protocol = SeederProtocol
+
+    def __init__(self, data: bytes, info_hash: bytes, piece_length: int, latency: float, loss: float):
+        self.data = data
+        self.info_hash = info_hash
+        self.piece_length = piece_length
+        self.num_pieces = -(-len(data) // piece_length)
+        self.latency = latency
+        self.loss = loss
+
+class TrackerResource(web_resource.Resource):
+    isLeaf = True
+
+    def __init__(self, ports: list):
+        super().__init__()
+        self.peers = b''.join(bytes([127, 0, 0, 1]) + struct.pack('>H', port) for port in ports)
+
+    def render_GET(self, request):
+        return Encoder().encode({b'interval' : 1800, b'peers' : self.peers})
+
+def start_swarm(directory: str, args):
+    '''
+    tracker and seeders, all on 127.0.0.1
+    '''
+
+    with open(os.path.join(directory, 'data.bin'), 'rb') as file:
+        data = file.read()
+
+    with open(os.path.join(directory, 'info_hash'), 'rb') as file:
+        info_hash = file.read()
+
+    ports = [args.seed_port + index for index in range(args.seeders)]
+    factory = SeederFactory(data, info_hash, args.piece_length * 1024, args.latency / 1000, args.loss)
+
+    for port in ports:
+        reactor.listenTCP(port, factory, interface='127.0.0.1')
+
+    reactor.listenTCP(args.tracker_port, server.Site(TrackerResource(ports)), interface='127.0.0.1')
+
+def run_swarm_process(directory: str, args) -> subprocess.Popen:
+    command = [sys.executable, os.path.abspath(__file__), '--serve', directory,
+               '--piece-length', str(args.piece_length),
+               '--seeders', str(args.seeders),
+               '--seed-port', str(args.seed_port),
+               '--tracker-port', str(args.tracker_port),
+               '--latency', str(args.latency),
+               '--loss', str(args.loss)]
+
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+
+    # wait for everything to be listening
+    if process.stdout.readline().strip() != 'ready':
+        process.kill()
+        raise Exception("Swarm process failed to start")
+
+    return process
+
+def download(torrent_path: str, args) -> dict:
+    '''
+    run the client until the download completes (or times out)
+    '''
+
+    stats = {'start' : None, 'first_byte' : None, 'done' : None}
+
+    meta_info = MetaInfo(torrent_path)
+    meta_info.parse_file()
+
+    tracker = Tracker(meta_info)
+    tracker.port = args.port
+
+    factory = PeerFactory(tracker.peers, meta_info, tracker.peer_id,
+                          min_requests=args.min_requests,
+                          max_requests=args.max_requests,
+                          max_connections=args.max_connections)
+
+    reactor.listenTCP(tracker.port, factory)
+
+    def check_first_byte():
+        if factory.downloaded > 0 and stats['first_byte'] is None:
+            stats['first_byte'] = time.perf_counter()
+            first_byte_loop.stop()
+
+    def finished(_):
+        stats['done'] = time.perf_counter()
+
+    def timed_out():
+        print("\nTimed out after %d seconds" % args.timeout)
+        reactor.stop()
+
+    first_byte_loop = task.LoopingCall(check_first_byte)
+    factory.finished.addCallback(finished)
+
+    def start():
+        stats['start'] = time.perf_counter()
+        first_byte_loop.start(0.001)
+        factory.ready.addCallback(lambda _: tracker.start(factory))
+
+    reactor.callWhenRunning(start)
+    timeout = reactor.callLater(args.timeout, timed_out)
+
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    reactor.run()
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+
+    if timeout.active():
+        timeout.cancel()
+
+    stats['cpu'] = ((usage_after.ru_utime - usage_before.ru_utime)
+                    + (usage_after.ru_stime - usage_before.ru_stime))
+    # kilobytes on Linux, bytes on macOS
+    stats['peak_rss'] = usage_after.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    stats['downloaded'] = factory.downloaded
+    stats['hash_failures'] = factory.verifier.num_failed
+
+    return stats
+
+def report(stats: dict, args):
+    size = args.size * 1024 * 1024
+
+    print("\n%d MiB, %d KiB pieces, %d seeder(s), %.0f ms latency, %.1f%% loss"
+          % (args.size, args.piece_length, args.seeders, args.latency, args.loss * 100))
+
+    if stats['done'] is None:
+        print("  download didn't finish (%d of %d bytes)" % (stats['downloaded'], size))
+        return
+
+    elapsed = stats['done'] - stats['start']
+
+    print("  time:           %8.2f s" % elapsed)
+    print("  throughput:     %8.2f MB/s" % (size / elapsed / 1e6))
+    print("  CPU per GB:     %8.2f s" % (stats['cpu'] / (size / 1e9)))
+    print("  peak RSS:       %8.1f MiB" % (stats['peak_rss'] / (1024 * 1024)))
+    print("  first byte:     %8.1f ms" % ((stats['first_byte'] - stats['start']) * 1000))
+    print("  hash failures:  %8d" % stats['hash_failures'])
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Loopback swarm benchmark")
+
+    parser.add_argument('--size', type=int, default=100, help="torrent size in MiB")
+    parser.add_argument('--piece-length', type=int, default=256, help="piece length in KiB")
+    parser.add_argument('--files', type=int, default=1, help="number of files in the torrent")
+    parser.add_argument('--seeders', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0, help="delay on every block in ms")
+    parser.add_argument('--loss', type=float, default=0,
+                        help="fraction of blocks that get an extra %d ms retransmission delay"
+                             % (RETRANSMIT_DELAY * 1000))
+    parser.add_argument('--in-process', action='store_true',
+                        help="run tracker and seeders in this process (their CPU time gets counted too)")
+    parser.add_argument('--port', type=int, default=6881, help="port the client listens on")
+    parser.add_argument('--seed-port', type=int, default=17000, help="first seeder port")
+    parser.add_argument('--tracker-port', type=int, default=16969)
+    parser.add_argument('--timeout', type=int, default=600, help="seconds before giving up")
+
+    # strategies to compare
+    parser.add_argument('--min-requests', type=int, default=4)
+    parser.add_argument('--max-requests', type=int, default=250)
+    parser.add_argument('--max-connections', type=int, default=50)
+
+    parser.add_argument('--serve', metavar='DIRECTORY', help=argparse.SUPPRESS)
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    # child process - just run the swarm
+    if args.serve:
+        start_swarm(args.serve, args)
+        reactor.callWhenRunning(print, 'ready', flush=True)
+        reactor.run()
+        sys.exit(0)
+
+    directory = tempfile.mkdtemp(prefix='swarm_bench_')
+    process = None
+
+    try:
+        torrent_path = make_torrent(directory, args.size * 1024 * 1024, args.piece_length * 1024,
+                                    args.files, args.tracker_port)
+
+        if args.in_process:
+            start_swarm(directory, args)
+        else:
+            process = run_swarm_process(directory, args)
+
+        # downloads/ (and resume data) end up in the temporary directory
+        os.chdir(directory)
+
+        report(download(torrent_path, args), args)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+        shutil.rmtree(directory, ignore_errors=True)
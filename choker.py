@@ -0,0 +1,98 @@
+from twisted.internet import task
+import random
+
+class Choker:
+    # seconds between rechokes
+    INTERVAL = 10
+
+    # optimistic unchoke moves on every this many rechokes (30 seconds)
+    OPTIMISTIC_ROUNDS = 3
+
+    def __init__(self, factory, upload_slots: int = 4):
+        '''
+        decides which peers we upload to
+
+        docs on the choking algorithm
+        https://wiki.theory.org/BitTorrentSpecification#Choking_and_Optimistic_Unchoking
+
+        every 10 seconds the interested peers that upload to us the
+        fastest get our upload slots (tit-for-tat), while one extra
+        slot rotates between the rest every 30 seconds so new peers
+        get a chance to show what they can do
+
+        once we're seeding nobody uploads to us, so peers are ranked
+        by how fast they download from us instead
+        '''
+
+        self.factory = factory
+        self.upload_slots = upload_slots
+
+        self.optimistic = None
+        self.rounds = 0
+
+        self.loop = task.LoopingCall(self.rechoke)
+
+    def start(self):
+        self.loop.start(self.INTERVAL, now=False)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def __get_rate(self, protocol) -> float:
+        if self.factory.completed_pieces.all():
+            return protocol.upload_meter.get_rate()
+
+        return protocol.download_meter.get_rate()
+
+    def rechoke(self):
+        interested = [protocol for protocol in self.factory.protocols
+                      if protocol.have_handshaked and protocol.peer_interested]
+
+        interested.sort(key=self.__get_rate, reverse=True)
+
+        unchoked = set(interested[:self.upload_slots])
+
+        if self.rounds % self.OPTIMISTIC_ROUNDS == 0 or self.optimistic not in interested:
+            self.__rotate_optimistic(interested, unchoked)
+
+        self.rounds += 1
+
+        if self.optimistic is not None:
+            unchoked.add(self.optimistic)
+
+        for protocol in self.factory.protocols:
+            if not protocol.have_handshaked:
+                continue
+
+            if protocol in unchoked and protocol.peer_choked:
+                protocol.send_unchoke()
+            elif protocol not in unchoked and not protocol.peer_choked:
+                protocol.send_choke()
+
+    def __rotate_optimistic(self, interested: list, unchoked: set):
+        candidates = [protocol for protocol in interested if protocol not in unchoked]
+
+        if len(candidates) == 0:
+            self.optimistic = None
+            return
+
+        # peers that haven't been unchoked yet are 3 times as likely to be
+        # picked, they haven't had a chance to upload anything to us
+        weights = [3 if protocol.upload_meter.total == 0 else 1 for protocol in candidates]
+
+        self.optimistic = random.choices(candidates, weights)[0]
+
+    def peer_interested(self, protocol):
+        '''
+        no need to wait for the next rechoke while a slot is free
+        '''
+
+        unchoked = sum(1 for other in self.factory.protocols if not other.peer_choked)
+
+        if protocol.peer_choked and unchoked < self.upload_slots + 1:
+            protocol.send_unchoke()
+
+    def peer_lost(self, protocol):
+        if protocol is self.optimistic:
+            self.optimistic = None
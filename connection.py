@@ -2,18 +2,56 @@ from metainfo import MetaInfo
 import struct
 from models.peer import Peer
 from models.piece import Piece
-import bitstring
+from models.piece_download import PieceDownload
+from storage import Storage
+from disk_scheduler import DiskScheduler
+from utils.piece_cache import PieceCache
+from verifier import PieceVerifier
+from resume import ResumeData
+from picker import PiecePicker
+from choker import Choker
+from connection_manager import ConnectionManager, ConnectionBudget
+from utils.rate_meter import RateMeter
+from utils.token_bucket import TokenBucket
+from metrics import MetricsRegistry
+from utils.bitfield import Bitfield
 from twisted.internet.protocol import Protocol, Factory
-from twisted.internet import reactor
-import os
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet import reactor, task, defer
+from twisted.python.threadpool import ThreadPool
+from zope.interface import implementer
+from collections import deque
 import tqdm
-import random
+import hashlib
+import time
 
 class PeerFactory(Factory):
     def __init__(self, 
                  peers: list, 
                  meta_info: MetaInfo, 
-                 peer_id: bytes):
+                 peer_id: bytes,
+                 min_requests: int = 4,
+                 max_requests: int = 250,
+                 max_hash_failures: int = 3,
+                 resume_interval: int = 30,
+                 keep_seeding: bool = False,
+                 upload_slots: int = 4,
+                 max_connections: int = 50,
+                 max_dials: int = 10,
+                 metrics: MetricsRegistry = None,
+                 max_download_rate: int = 0,
+                 max_upload_rate: int = 0,
+                 peer_download_rate: int = 0,
+                 peer_upload_rate: int = 0,
+                 global_download: TokenBucket = None,
+                 global_upload: TokenBucket = None,
+                 directory: str = None,
+                 disk_pool: ThreadPool = None,
+                 connection_budget: ConnectionBudget = None,
+                 show_progress: bool = True,
+                 exit_when_done: bool = True,
+                 disk_cache: PieceCache = None,
+                 fsync: str = DiskScheduler.FSYNC_CLOSE):
         self.meta_info = meta_info
         self.info_hash = meta_info.info_hash
         self.my_peer_id = peer_id
@@ -25,90 +63,529 @@ class PeerFactory(Factory):
         self.file_size = meta_info.length
         self.multi_files = meta_info.multi_files
 
-        self.progress_bar = tqdm.tqdm(total=self.num_pieces, initial=0, unit='pieces')
+        self.completed_pieces = Bitfield(self.num_pieces)
+        self.ongoing_pieces = Bitfield(self.num_pieces)
+        # should start with all 1s as all pieces are missing
+        self.missing_pieces = Bitfield(self.num_pieces, fill=True)
 
-        self.completed_pieces = bitstring.BitArray(self.num_pieces)
-        self.ongoing_pieces = bitstring.BitArray(self.num_pieces)
-        self.missing_pieces = bitstring.BitArray(self.num_pieces)
-        # bitarray should start with all 1s as all pieces are missing
-        self.missing_pieces.invert()
+        # pieces whose data has actually landed on disk
+        self.written_pieces = Bitfield(self.num_pieces)
 
-        self.data = [b'' for _ in range(self.num_pieces)]
+        # tracks how many peers have each piece for rarest first
+        self.picker = PiecePicker(self.num_pieces)
+
+        # pieces go straight to disk as they complete
+        self.storage = Storage(meta_info, directory)
+
+        # remembers which pieces are on disk between runs
+        self.resume = ResumeData(meta_info, self.storage)
+
+        # all reads and writes go through here
+        self.disk = DiskScheduler(self.storage, disk_pool, disk_cache, fsync)
+
+        # a session running lots of torrents reports progress itself
+        self.show_progress = show_progress
+        self.progress_bar = None
+
+        # pieces being downloaded, and the ones that still have
+        # blocks nobody has been asked for (dicts keep them in order
+        # so older pieces get finished first)
+        self.active_pieces = {}
+        self.partial_pieces = {}
+
+        # bounds for how many block requests each peer can have outstanding
+        self.min_requests = min_requests
+        self.max_requests = max_requests
+
+        # every piece is hashed before it's written
+        self.verifier = PieceVerifier()
+
+        # hosts of peers that sent us bad data too many times - by host,
+        # as a peer that connects to us comes from a new port every time
+        self.max_hash_failures = max_hash_failures
+        self.banned = set()
+        # host -> pieces it helped send that failed their hash check
+        self.hash_failures = {}
+
+        # piece index -> {block index: (peer, block hash)} for pieces
+        # that failed while more than one peer was sending blocks
+        self.suspect_blocks = {}
+
+        self.protocols = set()
+
+        # stay connected and keep uploading once the download is done,
+        # otherwise stop the reactor (or just this torrent, in a session)
+        self.keep_seeding = keep_seeding
+        self.exit_when_done = exit_when_done
+
+        # total bytes of block data sent and received (for the tracker)
+        self.uploaded = 0
+        self.downloaded = 0
+
+        # bytes/second limits for this torrent and for each of its peers
+        # (0 for no limit), chained onto limits shared with other torrents
+        self.download_bucket = TokenBucket(max_download_rate, parent=global_download)
+        self.upload_bucket = TokenBucket(max_upload_rate, parent=global_upload)
+        self.peer_download_rate = peer_download_rate
+        self.peer_upload_rate = peer_upload_rate
+
+        # fires when the last piece is completed during this run
+        self.finished = defer.Deferred()
+
+        # decides which peers get to download from us
+        self.choker = Choker(self, upload_slots)
+
+        # decides which peers we connect to
+        self.connection_manager = ConnectionManager(self, max_connections, max_dials, connection_budget)
+
+        # save progress every so often, and once all writes are done on exit
+        self.resume_loop = task.LoopingCall(self.save_resume)
+        self.resume_interval = resume_interval
+        self.stopped = False
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+        self.metrics = metrics or MetricsRegistry()
+        self.__register_metrics()
+
+        # pick up where the last run left off - nothing gets going until
+        # we know which pieces are on disk and the files are open (which
+        # has to wait for the check, as opening can change their size)
+        self.loaded = False
+        self.ready = self.resume.load()
+        self.ready.addErrback(self.__check_failed)
+        self.ready.addCallback(self.__resume_loaded)
+
+    def __check_failed(self, failure) -> list:
+        # stopped while waiting for the files to be checked
+        if failure.check(defer.CancelledError):
+            return []
+
+        print("\nCouldn't check existing files: %s (downloading everything)" % failure.getErrorMessage())
+
+        return []
+
+    def __resume_loaded(self, indices: list):
+        # removed from a session (or shut down) while the files were being checked
+        if self.stopped:
+            return
+
+        for index in indices:
+            self.update_completed_pieces(index)
+            self.written_pieces.set(index)
+            self.picker.discard(index)
+
+        d = self.disk.open()
+        d.addCallbacks(self.__files_opened, self.__open_failed)
+
+        return d
+
+    def __files_opened(self, _):
+        # stopped while the files were being created
+        if self.stopped:
+            return
+
+        self.loaded = True
+
+        if self.show_progress:
+            self.progress_bar = tqdm.tqdm(total=self.num_pieces, 
+                                          initial=self.completed_pieces.count, 
+                                          unit='pieces')
+
+        self.choker.start()
+        self.connection_manager.start()
+        self.resume_loop.start(self.resume_interval, now=False)
+
+        # nothing to download if everything was already on disk
+        if self.completed_pieces.all() and not self.keep_seeding:
+            reactor.callWhenRunning(self.__finish, None)
+
+    def __open_failed(self, failure):
+        # stopped while the files were being created
+        if failure.check(defer.CancelledError):
+            return
+
+        print("\nCouldn't open the files: %s" % failure.getErrorMessage())
+
+        self.stop()
+
+        # nothing else is running in a client that exits when done
+        if self.exit_when_done:
+            reactor.stop()
+
+    def __register_metrics(self):
+        '''
+        most of these are read straight from state that's kept anyway
+        when the metrics are asked for, only message parsing adds
+        anything to the hot path (a couple of clock reads per read from
+        the socket)
+        '''
+
+        metrics = self.metrics
+        handshaked = lambda: [protocol for protocol in self.protocols if protocol.have_handshaked]
+        per_peer = lambda func: lambda: {('%s:%s' % protocol.peer.address,): func(protocol)
+                                         for protocol in handshaked()}
+
+        metrics.gauge('peers_connected', 'Peers we have finished a handshake with',
+                      lambda: len(handshaked()))
+        metrics.gauge('download_rate_bytes', 'Bytes per second received from all peers',
+                      lambda: sum(protocol.download_meter.get_rate() for protocol in self.protocols))
+        metrics.gauge('upload_rate_bytes', 'Bytes per second sent to all peers',
+                      lambda: sum(protocol.upload_meter.get_rate() for protocol in self.protocols))
+        metrics.gauge('downloaded_bytes', 'Block data received', lambda: self.downloaded)
+        metrics.gauge('uploaded_bytes', 'Block data sent', lambda: self.uploaded)
+        metrics.gauge('outstanding_requests', 'Block requests waiting on a response',
+                      lambda: sum(len(protocol.requests) for protocol in self.protocols))
+
+        metrics.gauge('peer_download_rate_bytes', 'Bytes per second received from each peer',
+                      per_peer(lambda protocol: protocol.download_meter.get_rate()), ('peer',))
+        metrics.gauge('peer_upload_rate_bytes', 'Bytes per second sent to each peer',
+                      per_peer(lambda protocol: protocol.upload_meter.get_rate()), ('peer',))
+        metrics.gauge('peer_outstanding_requests', 'Block requests waiting on each peer',
+                      per_peer(lambda protocol: len(protocol.requests)), ('peer',))
+        metrics.gauge('peer_queue_depth', 'How many requests each peer is allowed to have out',
+                      per_peer(lambda protocol: protocol.queue_depth), ('peer',))
+
+        metrics.gauge('pieces_completed', 'Pieces verified (and written or being written)',
+                      lambda: self.completed_pieces.count)
+        metrics.gauge('pieces_hash_failed', 'Pieces that failed their hash check',
+                      lambda: self.verifier.num_failed)
+        metrics.gauge('hash_verify_seconds_avg', 'Average time to hash a piece',
+                      self.verifier.average_time)
+        metrics.gauge('hash_verify_seconds_max', 'Longest time to hash a piece',
+                      lambda: self.verifier.max_time)
+        metrics.gauge('disk_write_queue_depth', 'Piece writes waiting on the disk',
+                      self.disk.write_queue_depth)
+        metrics.gauge('disk_read_queue_depth', 'Upload reads waiting on the disk',
+                      self.disk.read_queue_depth)
+        metrics.gauge('disk_cache_hit_ratio', 'Fraction of upload reads served from the piece cache',
+                      self.disk.cache_hit_rate)
+        metrics.gauge('disk_cache_bytes', 'Bytes of pieces held in the cache',
+                      lambda: self.disk.cache.size)
+        metrics.gauge('disk_write_size_bytes_avg', 'Average size of a write after merging neighbouring pieces',
+                      self.disk.average_write_size)
+
+        self.parse_timer = metrics.timer('peer_parse_seconds',
+                                         'Time spent framing and handling messages per socket read')
+        self.messages_received = metrics.counter('peer_messages_received', 'Messages received from peers')
 
     def update_completed_pieces(self, index: int):
-        self.completed_pieces.set(1, index)
-        self.missing_pieces.set(0, index)
+        self.completed_pieces.set(index)
+        self.missing_pieces.clear(index)
+        self.ongoing_pieces.clear(index)
 
-    def get_rarest_piece(self, bitfield: bitstring.BitArray) -> Piece | None:
-        # create intersection of pieces that peer owns and are missing
-        desired_pieces = bitfield & self.missing_pieces
-        piece_indices = list(desired_pieces.findall(bitstring.Bits('0b1')))
+    def bytes_left(self) -> int:
+        '''
+        bytes of the torrent we still don't have (for the tracker)
+        '''
 
-        if len(piece_indices) == 0:
+        missing = self.num_pieces - self.completed_pieces.count
+        left = missing * self.pieces.piece_length
+
+        # last piece is usually shorter than the rest
+        if not self.completed_pieces[self.num_pieces - 1]:
+            left -= self.pieces.piece_length - self.pieces.last_piece_length
+
+        return left
+
+    def get_rarest_piece(self, bitfield: Bitfield, is_seed: bool = False) -> Piece | None:
+        '''
+        pick the rarest missing piece that the peer owns
+        and that no other peer is already downloading
+        '''
+
+        index = self.picker.pick(bitfield, is_seed)
+
+        if index is None:
             return None
 
-        index = random.choice(piece_indices)
+        self.ongoing_pieces.set(index)
 
         return self.pieces[index]
-    
-    def get_file_path(self, path):
-        file_name = path.pop()
-        directory = os.path.join(os.getcwd(), 'downloads', *path)
 
-        if len(path) > 0:
-            os.makedirs(directory)
-        
-        file_path = directory + '/' + file_name
+    def next_block(self, bitfield: Bitfield, is_seed: bool = False) -> tuple | None:
+        '''
+        find the next block to request from a peer - blocks from pieces
+        that are already underway come first, otherwise a new piece is
+        started
 
-        return open(file_path, 'wb')
-    
-    def write(self):
-        if self.multi_files:
-            self.__write_multi_files()
+        returns (piece index, begin, length)
+        '''
+
+        for download in self.partial_pieces.values():
+            if is_seed or bitfield[download.index]:
+                break
         else:
-            self.__write_file()
+            piece = self.get_rarest_piece(bitfield, is_seed)
+
+            # couldn't find any piece based on peer's bitfield
+            if piece is None:
+                return None
+
+            download = PieceDownload(piece)
+            self.active_pieces[piece.index] = download
+            self.partial_pieces[piece.index] = download
+
+        begin, length = download.next_block()
+
+        if not download.has_unrequested():
+            del self.partial_pieces[download.index]
+
+        return (download.index, begin, length)
+
+    def in_endgame(self) -> bool:
+        '''
+        endgame starts once every block that's left has been requested
+        from someone - from then on outstanding blocks get requested
+        from more than one peer so a slow peer can't hold up the end
+        '''
+
+        return (self.picker.num_wanted == 0
+                and len(self.partial_pieces) == 0
+                and len(self.active_pieces) > 0)
+
+    def endgame_block(self, bitfield: Bitfield, is_seed: bool, requests: dict) -> tuple | None:
+        '''
+        find a block that's been requested from another peer, but not
+        received yet, and hasn't already been requested from this peer
+
+        returns (piece index, begin, length)
+        '''
+
+        for download in self.active_pieces.values():
+            if not (is_seed or bitfield[download.index]):
+                continue
+
+            for block_index in range(download.piece.num_blocks):
+                if download.received[block_index]:
+                    continue
+
+                begin = block_index * Piece.BLOCK_SIZE
+
+                if (download.index, begin) not in requests:
+                    return (download.index, begin, download.piece.get_block_size(block_index))
+
+        return None
+
+    def cancel_block(self, index: int, begin: int, sender):
+        '''
+        block has arrived, so cancel it with every other peer
+        it was requested from during endgame
+        '''
+
+        for protocol in self.protocols:
+            if protocol is not sender and (index, begin) in protocol.requests:
+                protocol.send_cancel(index, begin)
+
+    def return_block(self, index: int, begin: int):
+        '''
+        a requested block isn't coming so it needs to be asked for again
+        '''
+
+        download = self.active_pieces.get(index)
+
+        if download is None:
+            return
+
+        download.return_block(begin)
+        self.partial_pieces[index] = download
+
+    def add_block(self, index: int, begin: int, block: memoryview, peer: Peer):
+        download = self.active_pieces.get(index)
+
+        # duplicate of a piece that's already finished
+        if download is None or not download.add_block(begin, block, peer):
+            return
+
+        if download.is_complete():
+            del self.active_pieces[index]
+            self.partial_pieces.pop(index, None)
+
+            d = self.verifier.verify(download.piece, download.data)
+            d.addCallback(self.__piece_verified, download)
+
+    def __piece_verified(self, valid: bool, download: PieceDownload):
+        if valid:
+            self.__check_suspects(download)
+            self.complete_piece(download.index, download.data)
+            return
+
+        # bad data - download the whole piece again
+        self.ongoing_pieces.clear(download.index)
+        self.picker.release(download.index)
+
+        peers = set(download.senders.values())
+
+        if len(peers) == 1:
+            self.__hash_failed(peers.pop().host)
+            return
+
+        # can't tell who's at fault yet, keep a hash of every block so it
+        # can be compared against the piece once it's downloaded correctly
+        suspects = self.suspect_blocks.setdefault(download.index, {})
+
+        for block_index, peer in download.senders.items():
+            block_hash = hashlib.sha1(download.get_block(block_index)).digest()
+            suspects.setdefault(block_index, []).append((peer, block_hash))
+
+    def __check_suspects(self, download: PieceDownload):
+        '''
+        piece finally passed, so any peer that sent a block
+        that doesn't match the good one is to blame
+        '''
+
+        suspects = self.suspect_blocks.pop(download.index, None)
+
+        if suspects is None:
+            return
+
+        blamed = set()
+
+        for block_index, senders in suspects.items():
+            block_hash = hashlib.sha1(download.get_block(block_index)).digest()
+
+            for peer, sent_hash in senders:
+                if sent_hash != block_hash:
+                    blamed.add(peer.host)
+
+        for host in blamed:
+            self.__hash_failed(host)
+
+    def __hash_failed(self, host: str):
+        failures = self.hash_failures.get(host, 0) + 1
+        self.hash_failures[host] = failures
+
+        if failures == self.max_hash_failures:
+            self.ban_peer(host)
+
+    def ban_peer(self, host: str):
+        '''
+        drop every connection to the host and never let it back in
+        '''
+
+        self.banned.add(host)
+
+        for protocol in list(self.protocols):
+            if protocol.peer.host == host:
+                protocol.transport.loseConnection()
     
-    def __write_file(self):
-        file = self.get_file_path([self.meta_info.name])
-
-        for index in range(self.num_pieces):
-            data = self.data[index]
-            file.write(data)
-
-    def __write_multi_files(self):
-        file_offset = 0
-        file_index = 0
-        file_len = self.meta_info.files[file_index]['length']
-        file = self.get_file_path(self.meta_info.files[file_index]['path'])
-
-        for index in range(self.num_pieces):
-            data = self.data[index]
-            data_len = len(self.data[index])
-
-            # piece won't all fit in file
-            if data_len + file_offset > file_len:
-                remaining_file_len = file_len - file_offset
-                curr_file_data = data[:remaining_file_len]
-                remaining_data = data[remaining_file_len:]
-
-                file.write(curr_file_data)
-                file.close()
-
-                file_index += 1
-                file_offset = 0
-                file_len = self.meta_info.files[file_index]['length']
-                file = self.get_file_path(self.meta_info.files[file_index]['path'])
-
-                file.write(remaining_data)
-                file_offset += len(remaining_data)
-            else:
-                file.write(data)
-                file_offset += data_len
+    def complete_piece(self, index: int, data: bytes):
+        '''
+        hand a finished piece off to be written to disk, once every
+        piece has actually landed on disk the download stops
+        '''
+
+        self.update_completed_pieces(index)
+
+        if self.progress_bar is not None:
+            self.progress_bar.update(1)
+
+        d = self.disk.write_piece(index, data)
+        d.addCallbacks(self.__write_done, self.__write_failed, 
+                       callbackArgs=(index,), errbackArgs=(index,))
+
+        # a failed write can take a piece away again, so every piece can
+        # be completed more than once - trackers are only told the first time
+        if self.completed_pieces.all() and not self.finished.called:
+            self.finished.callback(None)
+
+            if self.keep_seeding and self.progress_bar is not None:
+                print("\nDownload has completed successfully! Seeding...")
+
+    def __write_done(self, _, index: int):
+        self.written_pieces.set(index)
+
+        # piece can be served now, let everyone know
+        for protocol in self.protocols:
+            if protocol.have_handshaked:
+                protocol.send_have(index)
+
+        # only done once the last write landed - a failed write
+        # means that piece has to be downloaded again first
+        if not self.written_pieces.all():
+            return
+
+        for protocol in list(self.protocols):
+            if protocol.is_redundant():
+                protocol.transport.loseConnection()
+
+        if not self.keep_seeding:
+            self.disk.close().addCallback(self.__finish)
+
+    def __write_failed(self, failure, index: int):
+        print("\nFailed to write piece %d: %s" % (index, failure.getErrorMessage()))
+
+        # piece never made it to disk so it needs to be downloaded again
+        self.completed_pieces.clear(index)
+        self.missing_pieces.set(index)
+        self.picker.release(index)
+
+        if self.progress_bar is not None:
+            self.progress_bar.update(-1)
+
+    def save_resume(self):
+        self.resume.save(self.written_pieces)
+
+    def stop(self) -> defer.Deferred:
+        '''
+        drop every connection and stop all timers, fires once
+        pending writes have landed and progress has been saved
+        '''
+
+        # already stopped (removed from a session before shutdown)
+        if self.stopped:
+            return defer.succeed(None)
+
+        self.stopped = True
+
+        # no point checking the files of a torrent that's going away
+        if not self.loaded:
+            self.ready.cancel()
+
+        self.choker.stop()
+        self.connection_manager.stop()
+
+        if self.resume_loop.running:
+            self.resume_loop.stop()
+
+        for protocol in list(self.protocols):
+            protocol.transport.loseConnection()
+
+        # let pending writes finish so the saved file times match
+        d = self.disk.close()
+
+        # stopped before the files were checked, the saved progress is still right
+        if self.loaded:
+            d.addCallback(lambda _: self.save_resume())
+
+        return d
+
+    def __finish(self, _):
+        if not self.exit_when_done:
+            self.stop()
+            return
+
+        print("\nDownload has completed successfully!")
+        reactor.stop()
+
+    def create_protocol(self, peer: Peer):
+        return PeerProtocol(self, peer)
 
     def buildProtocol(self, addr):
-        return PeerProtocol(self)
+        # incoming connection - turned away if we're already at the limit,
+        # or until the files have been checked
+        if not self.loaded or not self.connection_manager.can_accept():
+            return None
 
+        return self.create_protocol(Peer(addr.host, addr.port))
+
+@implementer(IPushProducer)
 class PeerProtocol(Protocol):
+    # seconds worth of data to keep requested from each peer
+    REQUEST_QUEUE_TIME = 3
+
+    # most block requests from a peer we'll hold on to at once
+    MAX_UPLOAD_QUEUE = 250
+
     def __init__(self, factory: PeerFactory, peer: Peer):
         self.factory = factory
         self.peer = peer
@@ -119,23 +596,121 @@ class PeerProtocol(Protocol):
         self.peer_choked = True
         self.peer_interested = False
 
-        self.response = b''
-        self.remaining_message_len = 0
+        # reused receive buffer - frames are parsed straight out of it
+        self.buffer = bytearray()
 
+        self.sent_handshake = False
         self.have_handshaked = False
         self.peer_shared_pieces = False
+        self.is_seed = False
+
+        # (piece index, begin, length) of blocks the peer wants from us
+        self.upload_queue = deque()
+        self.pending_read = None
+        self.upload_paused = False
+        self.upload_meter = RateMeter()
+
+        # twisted never clears self.connected, so this is what says the peer is gone
+        self.disconnected = False
+
+        # rate limits, a timer is only set while a limit is holding us back
+        self.upload_bucket = TokenBucket(factory.peer_upload_rate, parent=factory.upload_bucket)
+        self.download_bucket = TokenBucket(factory.peer_download_rate, parent=factory.download_bucket)
+        self.upload_timer = None
+        self.download_timer = None
+
+        # (piece index, begin) -> length of every block requested but not received
+        self.requests = {}
+        self.queue_depth = self.factory.min_requests
+        self.download_meter = RateMeter()
+
+        # peer stopped sending blocks it was asked for
+        self.snubbed = False
+        self.last_block_time = time.monotonic()
+        self.connected_time = time.monotonic()
+
+        self.bitfield = Bitfield(self.factory.num_pieces)
+
+    def connectionMade(self):
+        self.connected_time = time.monotonic()
+        self.factory.protocols.add(self)
+        self.factory.connection_manager.connection_made(self)
+
+        # torrent was stopped while this connection was on its way
+        if self.factory.stopped or self.peer.host in self.factory.banned:
+            self.transport.loseConnection()
+            return
+
+        # transport pauses us when its write buffer fills up
+        self.transport.registerProducer(self, True)
+
+    def connectionLost(self, reason):
+        self.disconnected = True
+
+        # nobody left to send them to
+        self.upload_queue.clear()
+
+        self.factory.protocols.discard(self)
+        self.factory.choker.peer_lost(self)
+        self.factory.connection_manager.connection_lost(self)
+        self.remove_availability()
 
-        self.curr_piece = None
-        self.curr_bytes = b''
-        self.block_index = 0
+        for timer in (self.upload_timer, self.download_timer):
+            if timer is not None and timer.active():
+                timer.cancel()
 
-        self.bitfield = bitstring.BitArray(self.factory.num_pieces)
+        # let other peers finish what this one started
+        self.cancel_requests()
+
+    def remove_availability(self):
+        '''
+        take this peer's pieces out of the availability counts
+        '''
+
+        if self.is_seed:
+            self.is_seed = False
+            self.factory.picker.remove_seed()
+        else:
+            self.factory.picker.remove_pieces(self.bitfield.indices())
 
     def dataReceived(self, data: bytes) -> None:
+        self.buffer += data
+        self.download_bucket.consume(len(data))
+
+        # over the limit - stop reading from the socket until it's paid back,
+        # the kernel buffer fills up and TCP slows the peer down for us
+        if self.download_timer is None:
+            delay = self.download_bucket.get_delay()
+
+            if delay > 0:
+                self.transport.pauseProducing()
+                self.download_timer = reactor.callLater(delay, self.__resume_reading)
+
         if not self.have_handshaked:
-            self.receive_handshake(data)
-        else:
-            self.parse_message(data)
+            # wait until the whole handshake has arrived
+            if len(self.buffer) < 68:
+                return
+
+            self.receive_handshake(bytes(self.buffer[:68]))
+            del self.buffer[:68]
+
+            if not self.have_handshaked:
+                return
+
+        self.parse_message()
+
+    def __resume_reading(self):
+        delay = self.download_bucket.get_delay()
+
+        # another peer used up the shared limit in the meantime
+        if delay > 0:
+            self.download_timer = reactor.callLater(delay, self.__resume_reading)
+            return
+
+        self.download_timer = None
+
+        if not self.disconnected:
+            self.transport.resumeProducing()
 
     def send_handshake(self):
         '''
@@ -163,6 +738,8 @@ class PeerProtocol(Protocol):
 
         self.transport.write(handshake)
 
+        self.sent_handshake = True
+
     def receive_handshake(self, data: bytes):
         pstrlen = struct.unpack('>B', data[:1])[0]
 
@@ -172,6 +749,11 @@ class PeerProtocol(Protocol):
             self.transport.loseConnection()
             return
 
+        # peer has to be sharing the same torrent
+        if info_hash != self.factory.info_hash:
+            self.transport.loseConnection()
+            return
+
         # peer ID received should never match client peer ID
         if peer_id == self.factory.my_peer_id:
             self.transport.loseConnection()
@@ -189,74 +771,79 @@ class PeerProtocol(Protocol):
         self.peer.peer_id = peer_id
 
         self.have_handshaked = True
+        self.factory.connection_manager.handshake_done(self)
 
-        self.send_interested()
+        # peer connected to us, so it's waiting on our handshake
+        if not self.sent_handshake:
+            self.send_handshake()
 
-        # if there's more in the message than just handshake
-        if len(data) - 68 > 0:
-            self.parse_message(data[68:])
+        # bitfield has to be the first message after the handshake
+        self.send_bitfield()
+        self.send_interested()
 
-    def parse_message(self, response: bytes):
+    def parse_message(self):
         '''
         sometimes messages aren't sent in full so we need to parse
         the message and send once we have the full message
+
+        every complete message sitting in the buffer is handed to
+        handle_message as a memoryview (no copying), whatever is left
+        over is an incomplete message that stays in the buffer until
+        the rest of it arrives
+
+        - 4 bytes for message length (big endian)
+        - 1 byte for message id
+        - (length - 1) bytes for payload
         '''
 
-        # if it's not a valid message
-        if len(response) < 4:
-            return
-        
-        # if it's a new message
-        if self.remaining_message_len == 0:
-            length = struct.unpack('>I', response[:4])[0]
+        start = time.perf_counter()
+
+        buffer = self.buffer
+        buffer_len = len(buffer)
+        offset = 0
+        num_messages = 0
 
-            # keep alive message
-            if length == 0:
+        while buffer_len - offset >= 4:
+            length = struct.unpack_from('>I', buffer, offset)[0]
+            end = offset + 4 + length
+
+            # rest of the message hasn't arrived yet
+            if end > buffer_len:
+                break
+
+            if length == 0: # keep alive message
                 self.attempt_request()
-                return
-            elif length == 1: # message with no payload - just message_id
-                self.handle_message(response[4:])
-                self.parse_message(response[5:])
-            else: # full message 
-                # there's overflow if the expected length exceeds actual length
-                overflow = length > len(response[4:])
-
-                if overflow:
-                    self.remaining_message_len = length - len(response[4:])
-                    self.response += response
-                else:
-                    self.handle_message(response[4:length + 4])
-                    self.parse_message(response[length + 4:])
-        else: # if it's continuing previous message
-            overflow = self.remaining_message_len > len(response)
-
-            if overflow:
-                self.remaining_message_len -= len(response)
-                self.response += response
             else:
-                self.response += response[:self.remaining_message_len]
-                self.handle_message(self.response[4:])
+                # view has to be released before the buffer can be resized,
+                # handlers copy anything they want to keep
+                with memoryview(buffer)[offset + 4:end] as message:
+                    self.handle_message(message)
 
-                new_message = response[self.remaining_message_len:]
-                self.remaining_message_len = 0
-                self.response = b''
+            offset = end
+            num_messages += 1
 
-                self.parse_message(new_message)
+        # drop everything that's been handled
+        del buffer[:offset]
 
+        self.factory.messages_received.inc(num_messages)
+        self.factory.parse_timer.observe(time.perf_counter() - start)
 
-    def handle_message(self, response: bytes):
-        message_id = struct.unpack('B', response[:1])[0]
+    def handle_message(self, response: memoryview):
+        message_id = response[0]
         payload = response[1:]
 
         # for us to request pieces, we need to be interested & unchoked
         if message_id == 0:
             self.am_choked = True
+            # choking drops all of our outstanding requests
+            self.cancel_requests()
             # try to get unchoked
             self.send_interested()
         elif message_id == 1:
             self.am_choked = False
         elif message_id == 2:
             self.peer_interested = True
+            self.factory.choker.peer_interested(self)
         elif message_id == 3:
             self.peer_interested = False
         elif message_id == 4:
@@ -265,12 +852,12 @@ class PeerProtocol(Protocol):
         elif message_id == 5:
             self.handle_bitfield(payload)
             self.peer_shared_pieces = True
-        elif message_id == 6: # TODO: we're currently only leechers
+        elif message_id == 6:
             self.handle_request(payload)
         elif message_id == 7:
             self.handle_piece(payload)
-        elif message_id == 8: # TODO: we're currently only leechers
-            self.handle_cancel(payload) 
+        elif message_id == 8:
+            self.handle_cancel(payload)
         elif message_id == 9:
             pass
 
@@ -282,67 +869,90 @@ class PeerProtocol(Protocol):
 
         self.am_interested = True
 
-    def handle_have(self, payload: bytes):
+    def handle_have(self, payload: memoryview):
         index = struct.unpack('>I', payload)[0]
 
-        self.bitfield.set(1, index)
+        if index >= self.factory.num_pieces:
+            return
+
+        # repeated haves shouldn't count twice
+        if not self.bitfield[index]:
+            self.bitfield.set(index)
+            self.factory.picker.add_have(index)
+
+        if self.is_redundant():
+            self.transport.loseConnection()
+            return
 
         # make sure we're still interested
         if not self.am_interested:
             self.send_interested()
 
-    def handle_bitfield(self, payload: bytes):
-        piece_bits = bitstring.BitArray(payload)
+    def is_redundant(self) -> bool:
+        '''
+        both sides have every piece, so neither has anything to gain -
+        the connection is better spent on a peer that still needs data
+        '''
+
+        return self.bitfield.all() and self.factory.written_pieces.all()
+
+    def handle_bitfield(self, payload: memoryview):
+        # forget whatever the peer told us before (only if it sent have first)
+        self.remove_availability()
+
+        # spare bits at the end are dropped
+        self.bitfield = Bitfield.from_bytes(payload, self.factory.num_pieces)
 
-        split = min(self.bitfield.len, piece_bits.len)
+        if self.bitfield.all():
+            self.is_seed = True
+            self.factory.picker.add_seed()
+        else:
+            self.factory.picker.add_pieces(self.bitfield.indices())
 
-        self.bitfield = piece_bits[:split] + self.bitfield[split:]
+        if self.is_redundant():
+            self.transport.loseConnection()
+            return
 
         # send interested message after receiving bitfield
         if not self.am_interested:
             self.send_interested()
 
-    def handle_piece(self, payload: bytes):
+    def handle_piece(self, payload: memoryview):
         '''
         unpack the block and update piece status
         '''
 
-        if not self.curr_piece:
-            return
+        index, begin = struct.unpack_from('>II', payload)
+        block = payload[8:]
 
-        # TODO: clean this up so we can send a cancel message?
-        if self.factory.completed_pieces[self.curr_piece.index]:
-            self.curr_piece = None
-            self.curr_bytes = b''
-            self.block_index = 0
+        # ignore anything we didn't ask for (or have given up on)
+        if self.requests.pop((index, begin), None) is None:
             return
 
-        block_len = len(payload) - 8
+        self.download_meter.update(len(block))
+        self.factory.downloaded += len(block)
+        self.last_block_time = time.monotonic()
+        self.snubbed = False
+        self.update_queue_depth()
 
-        index, begin = struct.unpack('>II', payload[:8])
+        if self.factory.in_endgame():
+            self.factory.cancel_block(index, begin, self)
 
-        block = struct.unpack('%ds' % block_len, payload[8:])[0]
+        self.factory.add_block(index, begin, block, self.peer)
 
-        # add to current piece contents
-        self.curr_bytes += block
-        self.block_index += 1
+    def update_queue_depth(self):
+        '''
+        keep enough requests outstanding to cover REQUEST_QUEUE_TIME
+        seconds of the peer's download rate - until there's a rate to
+        go off of, grow the queue by one for every block received
+        '''
 
-        # if we've downloaded the piece, we're done with it
-        if self.curr_piece.is_downloaded(self.block_index):
-            if not self.factory.completed_pieces[self.curr_piece.index]:
-                self.factory.data[index] = self.curr_bytes
-                self.factory.progress_bar.update(1)
-                self.factory.update_completed_pieces(index)
-            
-            self.curr_piece = None
-            self.curr_bytes = b''
-            self.block_index = 0
+        if self.download_meter.has_sample:
+            depth = int(self.download_meter.rate * self.REQUEST_QUEUE_TIME / Piece.BLOCK_SIZE)
+        else:
+            depth = self.queue_depth + 1
 
-            # if all pieces are completed, end all connections
-            if self.factory.completed_pieces.all(True):
-                self.factory.write()
-                print("\nDownload has completed successfully!")
-                reactor.stop()
+        self.queue_depth = max(self.factory.min_requests, min(depth, self.factory.max_requests))
 
     def attempt_request(self):
         '''
@@ -352,44 +962,195 @@ class PeerProtocol(Protocol):
         if (self.am_interested 
             and not self.am_choked 
             and self.peer_shared_pieces 
-            and self.curr_piece is None):
+            and len(self.requests) < self.queue_depth):
             self.send_request()
 
     def send_request(self):
         '''
-        sends peer a request for an entire piece that's chosen at random
+        top the peer's request queue back up to queue_depth blocks,
+        the blocks can come from more than one piece
         '''
 
-        self.curr_piece = self.factory.get_rarest_piece(self.bitfield)
+        messages = []
 
-        # couldn't find any piece based on peer's bitfield
-        if self.curr_piece is None:
-            return
-        
-        piece_index = self.curr_piece.index
+        # snub timer only starts once there's something outstanding
+        if len(self.requests) == 0:
+            self.last_block_time = time.monotonic()
 
-        for block_index in range(0, self.curr_piece.num_blocks):
-            begin = block_index * self.curr_piece.BLOCK_SIZE
+        while len(self.requests) < self.queue_depth:
+            block = self.factory.next_block(self.bitfield, self.is_seed)
 
-            if self.curr_piece.on_final_block(block_index):
-                length = self.curr_piece.final_block_size
-            else:
-                length = self.curr_piece.BLOCK_SIZE
+            if block is None and self.factory.in_endgame():
+                block = self.factory.endgame_block(self.bitfield, self.is_seed, self.requests)
 
-            message = struct.pack('>IBIII', *[
+            # nothing left that this peer can give us
+            if block is None:
+                break
+
+            index, begin, length = block
+            self.requests[(index, begin)] = length
+
+            messages.append(struct.pack('>IBIII', *[
                 13,
                 6,
-                piece_index,
+                index,
                 begin,
                 length
-            ])
+            ]))
+
+        if len(messages) > 0:
+            self.transport.write(b''.join(messages))
+
+    def send_cancel(self, index: int, begin: int):
+        length = self.requests.pop((index, begin))
+
+        message = struct.pack('>IBIII', *[
+            13,
+            8,
+            index,
+            begin,
+            length
+        ])
+
+        self.transport.write(message)
+
+    def snub(self):
+        '''
+        peer is sitting on our requests, hand them to other peers
+        and only ask it for one block at a time until it delivers
+        '''
+
+        self.snubbed = True
+        self.queue_depth = 1
+
+        for index, begin in list(self.requests):
+            self.send_cancel(index, begin)
+            self.factory.return_block(index, begin)
+
+    def cancel_requests(self):
+        '''
+        hand every outstanding block back so other peers can request it
+        '''
+
+        for index, begin in self.requests:
+            self.factory.return_block(index, begin)
+
+        self.requests = {}
+
+    def send_bitfield(self):
+        '''
+        tell the peer which pieces we can upload, it's
+        optional when we don't have any yet
+        '''
+
+        if not self.factory.written_pieces.any():
+            return
+
+        bitfield = self.factory.written_pieces.tobytes()
+
+        self.transport.write(struct.pack('>IB', 1 + len(bitfield), 5) + bitfield)
+
+    def send_have(self, index: int):
+        message = struct.pack('>IBI', 5, 4, index)
+        self.transport.write(message)
+
+    def send_choke(self):
+        message = struct.pack('>IB', 1, 0)
+        self.transport.write(message)
+
+        self.peer_choked = True
+
+        # choked peers know their requests have been dropped
+        self.upload_queue.clear()
+
+    def send_unchoke(self):
+        message = struct.pack('>IB', 1, 1)
+        self.transport.write(message)
+
+        self.peer_choked = False
+
+    def handle_request(self, payload: memoryview):
+        '''
+        queue up a block the peer wants - requests we can't
+        (or won't) fulfill are ignored
+        '''
+
+        index, begin, length = struct.unpack('>III', payload)
+
+        if (self.peer_choked
+            or index >= self.factory.num_pieces
+            or not self.factory.written_pieces[index]
+            or length > Piece.BLOCK_SIZE
+            or begin + length > self.factory.pieces.get_length(index)
+            or len(self.upload_queue) >= self.MAX_UPLOAD_QUEUE):
+            return
+
+        self.upload_queue.append((index, begin, length))
+        self.serve_requests()
+
+    def handle_cancel(self, payload: memoryview):
+        request = struct.unpack('>III', payload)
+
+        try:
+            self.upload_queue.remove(request)
+        except ValueError:
+            # already sent (or never asked for)
+            pass
+
+    def serve_requests(self):
+        '''
+        send queued blocks one at a time, each block comes out of
+        the piece cache or is read off the disk on a worker thread
+        '''
+
+        if (self.disconnected
+            or self.pending_read is not None
+            or self.upload_paused
+            or self.upload_timer is not None
+            or len(self.upload_queue) == 0):
+            return
+
+        delay = self.upload_bucket.get_delay()
+
+        if delay > 0:
+            self.upload_timer = reactor.callLater(delay, self.__resume_upload)
+            return
+
+        index, begin, length = self.upload_queue.popleft()
+
+        self.pending_read = self.factory.disk.read_block(index, begin, length)
+        self.pending_read.addCallbacks(self.__send_block, self.__read_failed,
+                                       callbackArgs=(index, begin))
+
+    def __send_block(self, block: bytes, index: int, begin: int):
+        self.pending_read = None
+
+        if self.disconnected:
+            return
+
+        # header and block go out separately so they don't get copied together
+        self.transport.writeSequence([struct.pack('>IBII', 9 + len(block), 7, index, begin), block])
+
+        self.upload_bucket.consume(len(block))
+        self.upload_meter.update(len(block))
+        self.factory.uploaded += len(block)
+
+        self.serve_requests()
+
+    def __resume_upload(self):
+        self.upload_timer = None
+        self.serve_requests()
+
+    def __read_failed(self, failure):
+        self.pending_read = None
+        self.transport.loseConnection()
 
-            self.transport.write(message)
+    def pauseProducing(self):
+        self.upload_paused = True
 
-    # TODO: currently only leechers
-    def handle_request(self, payload: bytes):
-        pass
+    def resumeProducing(self):
+        self.upload_paused = False
+        self.serve_requests()
 
-    # TODO: currently only leechers
-    def handle_cancel(self, payload: bytes):
-        pass
\ No newline at end of file
+    def stopProducing(self):
+        self.upload_paused = True
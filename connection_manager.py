@@ -0,0 +1,311 @@
+from models.peer import Peer
+from twisted.internet import reactor, task
+from twisted.internet.endpoints import TCP4ClientEndpoint, TCP6ClientEndpoint, connectProtocol
+from collections import deque
+import heapq
+import itertools
+import time
+
+class ConnectionBudget:
+    def __init__(self, max_connections: int):
+        '''
+        connection limit shared by every torrent in a session - counts
+        open connections and dials in progress, and when one frees up
+        the torrents that were held back get another go at filling up
+        '''
+
+        self.max_connections = max_connections
+        self.used = 0
+
+        # managers that had candidates but no room left
+        self.waiting = {}
+
+    def available(self) -> bool:
+        return self.used < self.max_connections
+
+    def acquire(self):
+        self.used += 1
+
+    def release(self):
+        self.used -= 1
+
+        while self.waiting and self.available():
+            # oldest waiter first (dicts keep insertion order)
+            manager = next(iter(self.waiting))
+            del self.waiting[manager]
+            manager.fill()
+
+    def wait(self, manager):
+        self.waiting[manager] = None
+
+    def discard(self, manager):
+        self.waiting.pop(manager, None)
+
+class ConnectionManager:
+    # seconds to wait for a TCP connection / handshake before giving up
+    CONNECT_TIMEOUT = 10
+    HANDSHAKE_TIMEOUT = 10
+
+    # seconds without a block (while we have requests out) before a peer is snubbed
+    SNUB_TIMEOUT = 60
+
+    # seconds a peer gets to prove itself before it can be replaced
+    MIN_PEER_AGE = 60
+
+    # seconds between checks for snubbed/slow peers
+    INTERVAL = 10
+
+    # seconds before a peer we lost is dialed again (doubles with every
+    # failure in a row), and how many failures in a row before giving up
+    RETRY_DELAY = 60
+    MAX_RETRY_DELAY = 1800
+    MAX_FAILURES = 5
+
+    def __init__(self, factory, max_connections: int = 50, max_dials: int = 10, budget: ConnectionBudget = None):
+        '''
+        decides which peers we connect to and when
+
+        peers handed over from trackers go into a pool of candidates,
+        only max_dials connection attempts run at once and no more than
+        max_connections are ever open - once we're full, the slowest
+        peer is swapped out every so often for a new candidate
+
+        peers we dialed go back into the pool after a backoff when the
+        dial fails or the connection drops, until they've failed
+        MAX_FAILURES times in a row (a tracker handing them over again
+        still gives them another go)
+
+        a budget, when given, also caps connections across torrents
+        '''
+
+        self.factory = factory
+        self.max_connections = max_connections
+        self.max_dials = max_dials
+        self.budget = budget
+
+        self.candidates = deque()
+        # (retry time, sequence, peer) of peers waiting out their backoff
+        self.retries = []
+        self.sequence = itertools.count()
+        # (host, port) of every peer in candidates or retries
+        self.queued = set()
+        # (host, port) of peers we're dialing or connected to through a dial
+        self.dialed = set()
+        # (host, port) -> failed dials/dropped connections in a row
+        self.failures = {}
+
+        self.dialing = 0
+        # (host, port) -> Deferred of each dial still in progress
+        self.dials = {}
+        self.handshake_timers = {}
+        self.stopped = False
+
+        self.loop = task.LoopingCall(self.check_peers)
+
+    def start(self):
+        self.loop.start(self.INTERVAL, now=False)
+
+    def stop(self):
+        self.stopped = True
+
+        # a dial that connects after this would be writing into closed files
+        for d in list(self.dials.values()):
+            d.cancel()
+
+        if self.budget is not None:
+            self.budget.discard(self)
+
+        if self.loop.running:
+            self.loop.stop()
+
+    def add_peers(self, peers: list):
+        for peer in peers:
+            address = peer.address
+
+            if (address in self.queued
+                or address in self.dialed
+                or peer.host in self.factory.banned):
+                continue
+
+            self.queued.add(address)
+            self.candidates.append(peer)
+
+        self.fill()
+
+    def __retry_later(self, peer: Peer):
+        '''
+        back into the pool once its backoff is over, unless
+        it's been failing for too long (or we're done with it)
+        '''
+
+        address = peer.address
+        failures = self.failures.get(address, 0) + 1
+        self.failures[address] = failures
+
+        if (self.stopped
+            or failures > self.MAX_FAILURES
+            or address in self.queued
+            or peer.host in self.factory.banned):
+            return
+
+        delay = min(self.RETRY_DELAY * 2 ** (failures - 1), self.MAX_RETRY_DELAY)
+
+        self.queued.add(address)
+        heapq.heappush(self.retries, (time.monotonic() + delay, next(self.sequence), peer))
+
+    def __requeue_retries(self):
+        now = time.monotonic()
+
+        while self.retries and self.retries[0][0] <= now:
+            _, _, peer = heapq.heappop(self.retries)
+            self.candidates.append(peer)
+
+    def needs_peers(self) -> bool:
+        '''
+        out of candidates and well short of the connection limit
+        '''
+
+        return (len(self.candidates) == 0
+                and len(self.factory.protocols) + self.dialing < self.max_connections // 2)
+
+    def can_accept(self) -> bool:
+        if self.budget is not None and not self.budget.available():
+            return False
+
+        return len(self.factory.protocols) + self.dialing < self.max_connections
+
+    def fill(self):
+        '''
+        dial candidates until we're out of dial or connection slots
+        '''
+
+        while (not self.stopped
+               and len(self.candidates) > 0
+               and self.dialing < self.max_dials
+               and self.can_accept()):
+            peer = self.candidates.popleft()
+            self.queued.discard(peer.address)
+
+            if peer.host in self.factory.banned:
+                continue
+
+            self.__dial(peer)
+
+        # held back by other torrents, try again once they free something up
+        if (self.budget is not None
+            and not self.stopped
+            and len(self.candidates) > 0
+            and not self.budget.available()):
+            self.budget.wait(self)
+
+    def __dial(self, peer: Peer):
+        # IPv6 addresses need their own endpoint
+        if ':' in peer.host:
+            endpoint = TCP6ClientEndpoint(reactor, peer.host, peer.port, timeout=self.CONNECT_TIMEOUT)
+        else:
+            endpoint = TCP4ClientEndpoint(reactor, peer.host, peer.port, timeout=self.CONNECT_TIMEOUT)
+
+        self.dialing += 1
+        self.dialed.add(peer.address)
+
+        if self.budget is not None:
+            self.budget.acquire()
+
+        d = connectProtocol(endpoint, self.factory.create_protocol(peer))
+        self.dials[peer.address] = d
+        d.addCallbacks(self.__connected, self.__dial_failed, errbackArgs=(peer,))
+        d.addBoth(self.__dial_done, peer)
+
+    def __connected(self, protocol):
+        # connectionMade already dropped it
+        if self.stopped:
+            return
+
+        protocol.send_handshake()
+
+    def __dial_failed(self, failure, peer: Peer):
+        self.dialed.discard(peer.address)
+        self.__retry_later(peer)
+
+    def __dial_done(self, _, peer: Peer):
+        self.dials.pop(peer.address, None)
+        self.dialing -= 1
+
+        if self.budget is not None:
+            self.budget.release()
+
+        self.fill()
+
+    def connection_made(self, protocol):
+        if self.budget is not None:
+            self.budget.acquire()
+
+        self.handshake_timers[protocol] = reactor.callLater(self.HANDSHAKE_TIMEOUT,
+                                                            protocol.transport.loseConnection)
+
+    def handshake_done(self, protocol):
+        timer = self.handshake_timers.pop(protocol, None)
+
+        if timer is not None and timer.active():
+            timer.cancel()
+
+            # it works, so its failures start over
+            if protocol.have_handshaked:
+                self.failures.pop(protocol.peer.address, None)
+
+    def connection_lost(self, protocol):
+        self.handshake_done(protocol)
+
+        # peers that connected to us can't be dialed back (their port is
+        # just whatever their side picked), and nobody needs a peer when
+        # both sides have everything
+        if protocol.peer.address in self.dialed:
+            self.dialed.discard(protocol.peer.address)
+
+            if not protocol.is_redundant():
+                self.__retry_later(protocol.peer)
+
+        if self.budget is not None:
+            self.budget.release()
+
+        self.fill()
+
+    def __get_score(self, protocol) -> float:
+        '''
+        how much a peer is worth keeping - the rate it delivers data to us
+        '''
+
+        return protocol.download_meter.get_rate()
+
+    def check_peers(self):
+        '''
+        snub peers that stopped sending, and make room for a
+        new candidate by dropping the slowest peer if we're full
+
+        peers whose backoff is over go back into the pool first
+        '''
+
+        self.__requeue_retries()
+        self.fill()
+
+        now = time.monotonic()
+
+        for protocol in self.factory.protocols:
+            if (not protocol.snubbed
+                and len(protocol.requests) > 0
+                and now - protocol.last_block_time > self.SNUB_TIMEOUT):
+                protocol.snub()
+
+        if (len(self.candidates) == 0
+            or len(self.factory.protocols) < self.max_connections
+            or self.factory.completed_pieces.all()):
+            return
+
+        eligible = [protocol for protocol in self.factory.protocols
+                    if now - protocol.connected_time > self.MIN_PEER_AGE]
+
+        if len(eligible) == 0:
+            return
+
+        worst = min(eligible, key=self.__get_score)
+        worst.transport.loseConnection()
@@ -1,10 +1,56 @@
 import requests
-from collections import OrderedDict
 from urllib.parse import urlencode
+import threading
 import ipaddress
 from models.peer import Peer
+from utils.compact_peers import parse_compact_peers
 
 class HttpRequest:
+    # seconds before giving up on a tracker
+    TIMEOUT = 15
+
+    # client shared by every tracker that isn't given one
+    shared = None
+
+    def __init__(self):
+        '''
+        talks to HTTP(S) trackers, keeping one session per tracker
+        host so announces reuse an open (keep-alive) connection rather
+        than paying for a new TCP and TLS handshake every time
+
+        requests are blocking, so they're meant to be run on a thread
+        '''
+
+        # scheme://host:port -> requests.Session
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get_shared(cls):
+        if cls.shared is None:
+            cls.shared = cls()
+
+        return cls.shared
+
+    def __get_session(self, announce: tuple) -> requests.Session:
+        host = announce.scheme + '://' + announce.netloc
+
+        with self.lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                # responses get decompressed by requests
+                session.headers['Accept-Encoding'] = 'gzip'
+                self.sessions[host] = session
+
+            return self.sessions[host]
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+
+            self.sessions = {}
+
     def format_request(self, request_param: dict, announce: tuple) -> bytes:
         '''
         docs for understanding url formatting
@@ -13,85 +59,116 @@ class HttpRequest:
         
         url = announce.scheme + '://' + announce.netloc + announce.path + '?'
 
-        response = requests.get(url, params=request_param)
+        response = self.__get_session(announce).get(url, params=request_param, timeout=self.TIMEOUT)
+        response.raise_for_status()
         
         return response.content
-    
-    def parse_request(self, response) -> tuple:
+
+    def scrape_url(self, announce: tuple) -> str | None:
         '''
-        parse through the response and 
-        return all important information
+        docs for the scrape convention
+        https://wiki.theory.org/BitTorrentSpecification#Tracker_.27scrape.27_Convention
 
-        docs for understanding response
-        https://wiki.theory.org/BitTorrentSpecification#Tracker_Response
+        the last part of the announce path has to start with 'announce',
+        which gets swapped for 'scrape' - otherwise scrape isn't supported
         '''
 
-        peers = []
-        interval = response[b'interval']
+        directory, _, last = announce.path.rpartition('/')
 
-        if b'peers' in response and type(response[b'peers']) is bytes:
-            peers = self.__compact_peers(response[b'peers'])
-        elif b'peers6' in response and type(response[b'peers6']) is bytes:
-            peers = self.__ipv6_peers(response[b'peers6'])
-        elif b'peers' in response and type(response[b'peers']) is list:
-            peers = self.__dict_peers(response[b'peers'])
-        else:
-            raise TypeError('Not a supported tracker response - cannot be parsed')
-        
-        return (peers, interval)
-        
-    def __compact_peers(self, peers: bytes) -> list:
+        if not last.startswith('announce'):
+            return None
+
+        return (announce.scheme + '://' + announce.netloc + directory + '/'
+                + 'scrape' + last[len('announce'):])
+
+    def format_scrape(self, info_hashes: list, announce: tuple) -> bytes:
         '''
-        fetches the list of peers from compact mode
+        one request for every info hash (info_hash is repeated in the query)
+        '''
+
+        url = self.scrape_url(announce)
+
+        if url is None:
+            raise Exception('Tracker doesn\'t support scrape')
+
+        response = self.__get_session(announce).get(url,
+                                                    params={'info_hash' : info_hashes},
+                                                    timeout=self.TIMEOUT)
+        response.raise_for_status()
 
-        when peers is given in compact mode
-        - first 4 bytes are IP address
-        - next 2 bytes are port number
+        return response.content
+
+    def parse_scrape(self, response) -> dict:
+        '''
+        returns info hash -> {'complete', 'downloaded', 'incomplete'}
         '''
 
-        peers_list = []
+        self.__check_failure(response)
 
-        for index in range(0, len(peers), 6):
-            ip_bytes = peers[index : index + 4]
-            port_bytes = peers[index + 4 : index + 6]
+        files = {}
 
-            # funcs. utilize big endian by default
-            ip_address = str(ipaddress.IPv4Address(ip_bytes))
-            port = str(int.from_bytes(port_bytes))
+        for info_hash, stats in response.get(b'files', {}).items():
+            files[info_hash] = {'complete' : stats.get(b'complete', 0),
+                                'downloaded' : stats.get(b'downloaded', 0),
+                                'incomplete' : stats.get(b'incomplete', 0)}
 
-            peers_list.append(Peer(ip_address, port))
+        return files
 
-        return peers_list
+    def __check_failure(self, response):
+        '''
+        a failure reason means the request was refused and
+        nothing else in the response can be relied on
+        '''
+
+        if b'failure reason' in response:
+            raise Exception('Tracker refused request: %s'
+                            % response[b'failure reason'].decode(errors='replace'))
+
+        # request still went through, just pass it on
+        if b'warning message' in response:
+            print("\nTracker warning: %s" % response[b'warning message'].decode(errors='replace'))
     
-    def __ipv6_peers(self, peers: bytes) -> list:
+    def parse_request(self, response) -> tuple:
         '''
-        fetches the list of peers when given in bytes of IPv6
+        parse through the response and 
+        return all important information
 
-        - first 16 bytes are IP address
-        - next 2 bytes are port number
+        docs for understanding response
+        https://wiki.theory.org/BitTorrentSpecification#Tracker_Response
         '''
 
-        peers_list = []
+        self.__check_failure(response)
+
+        peers = []
+        interval = response[b'interval']
+        # optional - how often we're allowed to announce early
+        min_interval = response.get(b'min interval')
 
-        for index in range(0, len(peers), 18):
-            ip_address = str(ipaddress.IPv6Address(peers[index : index + 16]))
-            port = str(int.from_bytes(peers[index + 16 : index + 18]))
+        if b'peers' not in response and b'peers6' not in response:
+            raise TypeError('Not a supported tracker response - cannot be parsed')
 
-            peers_list.append(Peer(ip_address, port))
+        if type(response.get(b'peers')) is bytes:
+            peers = parse_compact_peers(response[b'peers'])
+        elif type(response.get(b'peers')) is list:
+            peers = self.__dict_peers(response[b'peers'])
 
-        return peers_list
-    
+        # dual stack trackers send their IPv6 peers alongside
+        if type(response.get(b'peers6')) is bytes:
+            peers.extend(parse_compact_peers(response[b'peers6'], ipv6=True))
+        
+        return (peers, interval, min_interval)
+        
     def __dict_peers(self, peers: list) -> list:
         '''
         fetches the list of peers when given in a 
-        list of OrderedDicts
+        list of dicts
         '''
 
         peers_list = []
 
         for peer in peers:
             ip_address = str(ipaddress.ip_address(peer[b'ip'].decode()))
-            port = str(peer[b'port'])
+            port = peer[b'port']
 
             peers_list.append(Peer(ip_address, port))
 
@@ -1,58 +1,28 @@
-import socket
 import struct
 import random
-import ipaddress
+import socket
 import time
-from models.peer import Peer
+from utils.compact_peers import parse_compact_peers
+from twisted.internet.protocol import DatagramProtocol
+from twisted.internet import reactor, defer
 
 class UdpRequest:
-    def __init__(self):
-        self.protocol_id = 0x41727101980
-        self.action = 0
-        self.transaction_id = self.__generate_random_val()
-        self.attempts = 0
-
-    def __generate_random_val(self) -> int:
-        '''
-        generate a random non-negative val
-        that is within 4 byte range
-        '''
-
-        return random.randint(0, 2**31 - 1)
-    
-    def send_request(self, sock: socket.socket, address: tuple, packet: bytes) -> bytes:
-        '''
-        docs for understanding buffer
-        https://docs.python.org/3/library/socket.html#socket.recv
-        '''
+    '''
+    builds and parses the packets of the UDP tracker protocol
 
-        sock.sendto(packet, address)
+    docs for the packet layouts
+    https://www.bittorrent.org/beps/bep_0015.html
+    '''
 
-        while True:
-            try:
-                # buffer of 2048 bytes
-                response = sock.recv(2048)
-                break
-            except TimeoutError:
-                # if there's no response after 5 attempts, raise exception
-                self.attempts += 1
-
-                if self.attempts >= 5:
-                    raise TimeoutError("Socket response wasn't completed in time")
-
-                # seems to be inconsistent with response time, keep trying
-                time.sleep(random.uniform(0.5, 2))
-                response = self.send_request(sock, address, packet)
-                break
+    PROTOCOL_ID = 0x41727101980
 
-        # response should not be empty
-        if not len(response) > 0:
-            raise Exception('Response should be 16 bytes (plus buffer)')
-        
-        return response
+    # actions
+    CONNECT = 0
+    ANNOUNCE = 1
+    SCRAPE = 2
+    ERROR = 3
 
-
-    def create_packet_conn(self) -> bytes:
+    def create_packet_conn(self, transaction_id: int) -> bytes:
         '''
         docs for understanding pack func.
         https://docs.python.org/3/library/struct.html
@@ -63,43 +33,32 @@ class UdpRequest:
         '''
 
         # should all be unsigned
-        return struct.pack('>QII', self.protocol_id, self.action, self.transaction_id)
-    
-    def parse_connection(self, response: bytes) -> dict:
+        return struct.pack('>QII', self.PROTOCOL_ID, self.CONNECT, transaction_id)
+
+    def parse_connection(self, response: bytes) -> int:
         '''
         - action is 4 bytes
         - transaction_id is 4 bytes
         - connection_id is 8 bytes (what we care about!)
         '''
 
-        action, transaction_id, connection_id = struct.unpack('>IIQ', response)
+        if len(response) < 16:
+            raise Exception('Connect response is too short')
 
-        # ensure transaction_id matches up
-        if transaction_id != self.transaction_id:
-            raise Exception('Transaction IDs don\'t match up')
-        
-        # ensure action remains consistent
-        if action != 0:
-            raise Exception('Inconsistent action - connection didn\'t process correctly')
+        _, _, connection_id = struct.unpack('>IIQ', response[:16])
 
-        return {
-            'action' : action,
-            'transaction_id' : transaction_id,
-            'connection_id' : connection_id
-        }
+        return connection_id
 
-    def create_packet_ann(self, param: dict) -> bytes:
+    def create_packet_ann(self, connection_id: int, transaction_id: int, param: dict) -> bytes:
         '''
-        docs for announce req
-        https://www.bittorrent.org/beps/bep_0015.html
+        announce request (98 bytes)
         '''
 
-        # should have total of 98 bytes
         return struct.pack('>QII20s20sQQQIIIiH',
                            *[
-                           param['connection_id'], # (8 bytes)
-                           param['action'], # defaulted to 1 (4 bytes)
-                           param['transaction_id'], # (4 bytes)
+                           connection_id, # (8 bytes)
+                           self.ANNOUNCE, # (4 bytes)
+                           transaction_id, # (4 bytes)
                            param['info_hash'], # (20 bytes)
                            param['peer_id'], # (20 bytes)
                            param['downloaded'], # (8 bytes)
@@ -107,51 +66,348 @@ class UdpRequest:
                            param['uploaded'], # (8 bytes)
                            param['event'], # (4 bytes)
                            param['IP address'], # defaulted to 0 (4 bytes)
-                           self.__generate_random_val(), # key (4 bytes)
+                           param['key'], # (4 bytes)
                            param['num_want'], # defaulted to -1 (4 bytes)
                            param['port']]) # (2 bytes)
-    
-    def parse_announce(self, response: bytes):
-        '''
-        TODO: currently only supports IPv4 due to 
-        gethostbyname() func. returning IPv4 only,
-        look into how to implement IPv6
-
-        docs regarding IPv6 (might not need to be implemented?)
-        https://www.bittorrent.org/beps/bep_0015.html
 
+    def parse_announce(self, response: bytes, ipv6: bool = False) -> dict:
+        '''
         - action is 4 bytes
         - transaction_id is 4 bytes
         - interval is 4 bytes
         - leechers is 4 bytes
         - seeders is 4 bytes
-        - IP address is 4 bytes (n times for each peer)
+        - IP address is 4 bytes, or 16 if the announce went over IPv6 (n times for each peer)
         - TCP port is 2 bytes (n times for each peer)
         '''
 
-        action, transaction_id, interval, leechers, seeders = struct.unpack('>IIIII', response[:20])
+        if len(response) < 20:
+            raise Exception('Announce response is too short')
 
-        # ensure action remains consistent
-        if action != 1:
-            raise Exception('Inconsistent action - announcement didn\'t process correctly')
-        
-        peers_list = []
+        _, _, interval, leechers, seeders = struct.unpack('>IIIII', response[:20])
 
-        for index in range(20, len(response), 6):
-            ip_bytes = response[index : index + 4]
-            port_bytes = response[index + 4 : index + 6]
+        peers_list = parse_compact_peers(memoryview(response)[20:], ipv6)
 
-            ip_address = str(ipaddress.IPv4Address(ip_bytes))
-            port = str(int.from_bytes(port_bytes))
-
-            peers_list.append(Peer(ip_address, port))
-
-        # TODO: do we care about/need any of this aside from interval and peers?
         return {
-            'action' : action,
-            'transaction_id' : transaction_id,
             'interval' : interval,
             'leechers' : leechers,
             'seeders' : seeders,
             'peers' : peers_list
-        }
\ No newline at end of file
+        }
+
+    def create_packet_scrape(self, connection_id: int, transaction_id: int, info_hashes: list) -> bytes:
+        '''
+        scrape request - up to about 74 info hashes fit in one packet
+        '''
+
+        return struct.pack('>QII', connection_id, self.SCRAPE, transaction_id) + b''.join(info_hashes)
+
+    def parse_scrape(self, response: bytes, info_hashes: list) -> dict:
+        '''
+        - action is 4 bytes
+        - transaction_id is 4 bytes
+        - seeders, completed and leechers are 4 bytes each (n times, in request order)
+
+        returns info hash -> dict with the same keys an HTTP scrape uses
+        '''
+
+        files = {}
+
+        for position, info_hash in enumerate(info_hashes):
+            offset = 8 + position * 12
+
+            if offset + 12 > len(response):
+                break
+
+            seeders, completed, leechers = struct.unpack('>III', response[offset : offset + 12])
+
+            files[info_hash] = {'complete' : seeders,
+                                'downloaded' : completed,
+                                'incomplete' : leechers}
+
+        return files
+
+class UdpTransaction:
+    def __init__(self, address: tuple, action: int, packet_builder, deferred: defer.Deferred,
+                 max_retries: int):
+        '''
+        one outstanding request to a tracker - packet_builder
+        gets (connection_id, transaction_id) and returns the packet
+        '''
+
+        self.address = address
+        self.action = action
+        self.packet_builder = packet_builder
+        self.deferred = deferred
+        self.max_retries = max_retries
+
+        # n in the 15 * 2^n timeout, kept across reconnects
+        self.attempt = 0
+        self.transaction_id = None
+        self.timer = None
+
+class UdpTrackerSocket(DatagramProtocol):
+    def __init__(self, client):
+        '''
+        one listening socket, everything it receives goes to the client
+        '''
+
+        self.client = client
+
+    def datagramReceived(self, data: bytes, addr: tuple):
+        self.client.datagram_received(data, addr)
+
+class UdpTrackerClient:
+    # connection ids can be used for this many seconds
+    CONNECTION_LIFETIME = 60
+
+    # waiting 15 * 2^n seconds on attempt n, giving up after n = 8
+    BASE_TIMEOUT = 15
+    MAX_RETRIES = 8
+
+    # the most info hashes that fit into one scrape packet
+    MAX_SCRAPE = 74
+
+    # client shared by every tracker that isn't given one
+    shared = None
+
+    def __init__(self):
+        '''
+        talks to every UDP tracker over one socket per address family,
+        matching responses to requests by transaction id, so any number
+        of trackers and torrents can share it
+
+        connection ids are cached for their full minute, so a tracker
+        that was contacted recently is announced to in one round trip
+        rather than two
+
+        docs for the protocol
+        https://www.bittorrent.org/beps/bep_0015.html
+        '''
+
+        self.codec = UdpRequest()
+
+        # transaction id -> UdpTransaction
+        self.transactions = {}
+
+        # address -> (connection id, time it stops being valid)
+        self.connections = {}
+
+        # address -> transactions waiting on a connect that's already out
+        self.connecting = {}
+
+        # socket family -> listening port (IPv4 and IPv6 need their own)
+        self.ports = {}
+
+        # key sent with announces so trackers can tell us apart if our IP changes
+        self.key = random.randint(0, 2**32 - 1)
+
+    @classmethod
+    def get_shared(cls):
+        if cls.shared is None:
+            cls.shared = cls()
+
+        return cls.shared
+
+    def announce(self, address: tuple, request_param: dict, max_retries: int = None) -> defer.Deferred:
+        '''
+        address is a resolved (ip, port), fires with the parsed response
+
+        max_retries caps n in the 15 * 2^n timeout (MAX_RETRIES by default),
+        so a caller with other trackers to try doesn't wait hours on a dead one
+        '''
+
+        request_param = dict(request_param, key=self.key)
+        ipv6 = self.__is_ipv6(address)
+
+        d = self.__request(address, self.codec.ANNOUNCE,
+                           lambda connection_id, transaction_id:
+                               self.codec.create_packet_ann(connection_id, transaction_id, request_param),
+                           max_retries)
+        d.addCallback(self.codec.parse_announce, ipv6)
+
+        return d
+
+    def scrape(self, address: tuple, info_hashes: list) -> defer.Deferred:
+        '''
+        fires with info hash -> {'complete', 'downloaded', 'incomplete'},
+        batches of more than MAX_SCRAPE hashes go out as separate requests
+        '''
+
+        batches = []
+
+        for start in range(0, len(info_hashes), self.MAX_SCRAPE):
+            batch = info_hashes[start : start + self.MAX_SCRAPE]
+
+            d = self.__request(address, self.codec.SCRAPE,
+                               lambda connection_id, transaction_id, batch=batch:
+                                   self.codec.create_packet_scrape(connection_id, transaction_id, batch))
+            d.addCallback(self.codec.parse_scrape, batch)
+
+            batches.append(d)
+
+        d = defer.gatherResults(batches, consumeErrors=True)
+        d.addCallback(self.__merge_scrapes)
+
+        return d
+
+    def __merge_scrapes(self, results: list) -> dict:
+        files = {}
+
+        for result in results:
+            files.update(result)
+
+        return files
+
+    def __is_ipv6(self, address: tuple) -> bool:
+        return ':' in address[0]
+
+    def __get_port(self, address: tuple):
+        family = socket.AF_INET6 if self.__is_ipv6(address) else socket.AF_INET
+
+        if family not in self.ports:
+            interface = '::' if family == socket.AF_INET6 else ''
+            self.ports[family] = reactor.listenUDP(0, UdpTrackerSocket(self), interface=interface)
+
+        return self.ports[family]
+
+    def __new_transaction_id(self) -> int:
+        while True:
+            transaction_id = random.randint(0, 2**32 - 1)
+
+            if transaction_id not in self.transactions:
+                return transaction_id
+
+    def __get_connection_id(self, address: tuple) -> int | None:
+        connection = self.connections.get(address)
+
+        if connection is None:
+            return None
+
+        connection_id, expires = connection
+
+        if time.monotonic() >= expires:
+            del self.connections[address]
+            return None
+
+        return connection_id
+
+    def __request(self, address: tuple, action: int, packet_builder, max_retries: int = None) -> defer.Deferred:
+        if max_retries is None:
+            max_retries = self.MAX_RETRIES
+
+        d = defer.Deferred()
+        self.__attempt(UdpTransaction(address, action, packet_builder, d, max_retries))
+
+        return d
+
+    def __attempt(self, transaction: UdpTransaction):
+        '''
+        send the request, connecting first if we don't have
+        a valid connection id for the tracker
+        '''
+
+        connection_id = self.__get_connection_id(transaction.address)
+
+        if connection_id is not None:
+            self.__send(transaction, connection_id)
+            return
+
+        waiting = self.connecting.get(transaction.address)
+
+        # someone else is already connecting to this tracker
+        if waiting is not None:
+            waiting.append(transaction)
+            return
+
+        self.connecting[transaction.address] = [transaction]
+
+        connect = UdpTransaction(transaction.address, self.codec.CONNECT,
+                                 lambda _, transaction_id: self.codec.create_packet_conn(transaction_id),
+                                 defer.Deferred(), transaction.max_retries)
+        connect.attempt = transaction.attempt
+
+        # a reply that can't be parsed fails the waiting requests too, rather
+        # than leaving them (and everyone after them) stuck in connecting
+        connect.deferred.addCallback(self.__connected, transaction.address)
+        connect.deferred.addErrback(self.__connect_failed, transaction.address)
+
+        self.__send(connect, None)
+
+    def __connected(self, response: bytes, address: tuple):
+        connection_id = self.codec.parse_connection(response)
+        self.connections[address] = (connection_id, time.monotonic() + self.CONNECTION_LIFETIME)
+
+        for transaction in self.connecting.pop(address, []):
+            self.__send(transaction, connection_id)
+
+    def __connect_failed(self, failure, address: tuple):
+        for transaction in self.connecting.pop(address, []):
+            transaction.deferred.errback(failure)
+
+    def __send(self, transaction: UdpTransaction, connection_id: int | None):
+        transaction.transaction_id = self.__new_transaction_id()
+        self.transactions[transaction.transaction_id] = transaction
+
+        packet = transaction.packet_builder(connection_id, transaction.transaction_id)
+
+        self.__write(transaction, packet)
+
+    def __write(self, transaction: UdpTransaction, packet: bytes):
+        try:
+            self.__get_port(transaction.address).write(packet, transaction.address)
+        except Exception as error:
+            self.__finish(transaction, error)
+            return
+
+        timeout = self.BASE_TIMEOUT * 2 ** transaction.attempt
+        transaction.timer = reactor.callLater(timeout, self.__timed_out, transaction, packet)
+
+    def __timed_out(self, transaction: UdpTransaction, packet: bytes):
+        transaction.attempt += 1
+
+        if transaction.attempt > transaction.max_retries:
+            self.__finish(transaction, TimeoutError("UDP tracker didn't respond in time"))
+            return
+
+        # connection id ran out while we were waiting, get a new one first
+        if (transaction.action != self.codec.CONNECT
+            and self.__get_connection_id(transaction.address) is None):
+            del self.transactions[transaction.transaction_id]
+            self.__attempt(transaction)
+            return
+
+        self.__write(transaction, packet)
+
+    def datagram_received(self, data: bytes, addr: tuple):
+        if len(data) < 8:
+            return
+
+        action, transaction_id = struct.unpack('>II', data[:8])
+        transaction = self.transactions.get(transaction_id)
+
+        # response to something else, or a late duplicate
+        if transaction is None or transaction.address[:2] != addr[:2]:
+            return
+
+        if action == self.codec.ERROR:
+            # connection id might be what the tracker didn't like
+            self.connections.pop(transaction.address, None)
+
+            # the rest of the packet is the message
+            self.__finish(transaction, Exception(data[8:].decode(errors='replace')))
+        elif action != transaction.action:
+            self.__finish(transaction, Exception('Unexpected action %d in tracker response' % action))
+        else:
+            self.__finish(transaction, data)
+
+    def __finish(self, transaction: UdpTransaction, result):
+        self.transactions.pop(transaction.transaction_id, None)
+
+        if transaction.timer is not None and transaction.timer.active():
+            transaction.timer.cancel()
+
+        if isinstance(result, Exception):
+            transaction.deferred.errback(result)
+        else:
+            transaction.deferred.callback(result)
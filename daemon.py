@@ -0,0 +1,85 @@
+from session import Session
+from disk_scheduler import DiskScheduler
+from main import start_metrics
+from metrics import MetricsRegistry
+from profiling import ReactorWatchdog
+from twisted.internet import reactor, task
+import argparse
+import os
+
+# seconds between looking for new .torrent files
+RESCAN_INTERVAL = 10
+
+# seconds between status lines
+STATUS_INTERVAL = 30
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Peer2Peer BitTorrent client - runs every torrent in a directory")
+
+    parser.add_argument('directory', help="directory of .torrent files (new ones are picked up while running)")
+    parser.add_argument('--download-dir', help="where downloaded files go (default: downloads/)")
+    parser.add_argument('--port', type=int, default=6881, help="port peers connect to, shared by every torrent")
+    parser.add_argument('--max-connections', type=int, default=500, help="connections across every torrent")
+    parser.add_argument('--torrent-connections', type=int, default=50, help="connections for any one torrent")
+    parser.add_argument('--disk-threads', type=int, default=Session.DISK_THREADS,
+                        help="worker threads doing disk I/O")
+    parser.add_argument('--cache-size', type=int, default=Session.CACHE_SIZE // 2**20, metavar='MIB',
+                        help="memory for caching pieces that get uploaded, across every torrent")
+    parser.add_argument('--fsync', choices=DiskScheduler.FSYNC_POLICIES, default=DiskScheduler.FSYNC_CLOSE,
+                        help="when written data is flushed to the disk")
+    parser.add_argument('--no-seed', action='store_true', help="stop uploading a torrent once it's done")
+    parser.add_argument('--watchdog-threshold', type=float, default=ReactorWatchdog.THRESHOLD,
+                        help="seconds the reactor can be blocked before its stack is logged")
+
+    # 0 means no limit
+    parser.add_argument('--download-limit', type=int, default=0, metavar='KIB/S',
+                        help="max download rate across every torrent")
+    parser.add_argument('--upload-limit', type=int, default=0, metavar='KIB/S',
+                        help="max upload rate across every torrent")
+    parser.add_argument('--torrent-download-limit', type=int, default=0, metavar='KIB/S',
+                        help="max download rate for each torrent")
+    parser.add_argument('--torrent-upload-limit', type=int, default=0, metavar='KIB/S',
+                        help="max upload rate for each torrent")
+    parser.add_argument('--peer-download-limit', type=int, default=0, metavar='KIB/S',
+                        help="max download rate from each peer")
+    parser.add_argument('--peer-upload-limit', type=int, default=0, metavar='KIB/S',
+                        help="max upload rate to each peer")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if not os.path.isdir(args.directory):
+        raise SystemExit("%s is not a directory" % args.directory)
+
+    metrics = MetricsRegistry()
+
+    session = Session(args.download_dir,
+                      port=args.port,
+                      max_connections=args.max_connections,
+                      max_download_rate=args.download_limit * 1024,
+                      max_upload_rate=args.upload_limit * 1024,
+                      disk_threads=args.disk_threads,
+                      cache_size=args.cache_size * 2**20,
+                      metrics=metrics,
+                      torrent_options={'keep_seeding' : not args.no_seed,
+                                       'fsync' : args.fsync,
+                                       'max_connections' : args.torrent_connections,
+                                       'max_download_rate' : args.torrent_download_limit * 1024,
+                                       'max_upload_rate' : args.torrent_upload_limit * 1024,
+                                       'peer_download_rate' : args.peer_download_limit * 1024,
+                                       'peer_upload_rate' : args.peer_upload_limit * 1024})
+    session.start()
+
+    def load_torrents():
+        for torrent in session.load_directory(args.directory):
+            print("Loaded %s (%d pieces)" % (torrent.name, torrent.meta_info.num_pieces))
+
+    # new files dropped into the directory get picked up as well
+    task.LoopingCall(load_torrents).start(RESCAN_INTERVAL)
+    task.LoopingCall(lambda: print(session.status())).start(STATUS_INTERVAL, now=False)
+
+    start_metrics(metrics, args.watchdog_threshold)
+
+    reactor.run()
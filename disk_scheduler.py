@@ -0,0 +1,385 @@
+from storage import Storage
+from utils.piece_cache import PieceCache
+from twisted.internet import reactor, threads, defer, task
+from twisted.python.threadpool import ThreadPool
+from twisted.python.failure import Failure
+import itertools
+import bisect
+
+class DiskScheduler:
+    # when written data gets flushed all the way to the disk
+    FSYNC_NEVER = 'never'
+    FSYNC_BATCH = 'batch'
+    FSYNC_INTERVAL = 'interval'
+    FSYNC_CLOSE = 'close'
+    FSYNC_POLICIES = (FSYNC_NEVER, FSYNC_BATCH, FSYNC_INTERVAL, FSYNC_CLOSE)
+
+    # seconds between syncs with the interval policy
+    FSYNC_INTERVAL_SECONDS = 30
+
+    # bytes of pieces kept in memory for uploading
+    CACHE_SIZE = 64 * 2**20
+
+    # reads handed to the thread pool at once
+    MAX_READS = 4
+
+    def __init__(self,
+                 storage: Storage,
+                 pool: ThreadPool = None,
+                 cache: PieceCache = None,
+                 fsync: str = FSYNC_CLOSE,
+                 fsync_interval: float = FSYNC_INTERVAL_SECONDS):
+        '''
+        sits between the factory and the files so the disk sees a few
+        large sequential operations rather than lots of small scattered ones
+
+        - verified pieces queue up while a write is in progress, then go
+          out together sorted by offset, with neighbouring pieces merged
+          into one vectored write
+        - upload reads go through an LRU cache of whole pieces - a miss
+          reads the entire piece once instead of one seek per block, and
+          freshly written pieces go in too as they're what peers ask for
+        - reads that do hit the disk are served in offset order, sweeping
+          across the torrent like an elevator
+
+        fsync policy is one of never (leave it to the OS), batch (after
+        every write), interval (every fsync_interval seconds) or close
+        (once, when the files are closed)
+
+        I/O runs on the given thread pool, so torrents in the same session
+        can share one (the reactor's own pool otherwise), the same goes
+        for the cache
+        '''
+
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy %r" % fsync)
+
+        self.storage = storage
+        self.pool = pool or reactor.getThreadPool()
+        self.cache = cache if cache is not None else PieceCache(self.CACHE_SIZE)
+        self.info_hash = storage.meta_info.info_hash
+        self.piece_length = storage.piece_length
+        self.fsync = fsync
+
+        # pieces that are too big for the cache are read a block at a time
+        self.cache_pieces = self.cache.max_size >= self.piece_length * 4
+
+        # piece index -> (data, Deferred) waiting for the next batch
+        self.write_queue = {}
+        # pieces in the batch being written right now
+        self.writing = {}
+        # files written to since they were last synced
+        self.dirty = set()
+
+        # (offset, sequence, length, Deferred) sorted by offset, the sequence
+        # keeps reads of the same offset in order (and Deferreds from being compared)
+        self.read_queue = []
+        self.sequence = itertools.count()
+        self.reads_in_flight = 0
+        # offset of the last read sent to the disk
+        self.head = 0
+
+        # piece index -> [(Deferred, begin, length)] of blocks waiting on
+        # that piece being read into the cache
+        self.loading = {}
+
+        # fired once every queued write has landed
+        self.drain_waiters = []
+
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.pieces_written = 0
+        self.bytes_written = 0
+        self.num_writes = 0
+
+        self.sync_loop = None
+        # fires once the files are open (or failed to), closing waits on it
+        self.opening = None
+        # the first close, later ones wait on it rather than racing it
+        self.closing = None
+        self.close_result = None
+
+        if fsync == self.FSYNC_INTERVAL:
+            self.sync_loop = task.LoopingCall(self.__sync_dirty)
+            self.sync_loop.start(fsync_interval, now=False)
+
+    def open(self) -> defer.Deferred:
+        '''
+        create the files at their full size on the pool - without native
+        fallocate (NFS for one) that means writing out every block
+        '''
+
+        self.opening = defer.Deferred()
+
+        # a copy, so cancelling it can't let a close in before the open is done
+        d = defer.Deferred()
+        opened = threads.deferToThreadPool(reactor, self.pool, self.storage.open)
+        opened.addBoth(self.__opened, d)
+
+        return d
+
+    def __opened(self, result, d: defer.Deferred):
+        opening, self.opening = self.opening, None
+        opening.callback(None)
+
+        if isinstance(result, Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+    def write_piece(self, index: int, data) -> defer.Deferred:
+        '''
+        fires once the piece is on disk (and synced, with the batch policy)
+        '''
+
+        d = defer.Deferred()
+        self.write_queue[index] = (data, d)
+        self.__flush()
+
+        return d
+
+    def __flush(self):
+        # one batch at a time, whatever queues up meanwhile goes out in the next one
+        if self.writing or not self.write_queue:
+            return
+
+        self.writing = self.write_queue
+        self.write_queue = {}
+
+        runs = []
+        previous = None
+
+        for index in sorted(self.writing):
+            data = self.writing[index][0]
+
+            # carries on from the last piece, so it's one write
+            if previous is not None and index == previous + 1:
+                runs[-1][1].append(index)
+                runs[-1][2].append(data)
+            else:
+                runs.append((index * self.piece_length, [index], [data]))
+
+            previous = index
+
+        d = threads.deferToThreadPool(reactor, self.pool, self.__write_runs,
+                                      [(offset, buffers) for offset, _, buffers in runs])
+        d.addBoth(self.__batch_done, runs)
+
+    def __write_runs(self, runs: list) -> list:
+        # runs on a worker thread - a failed run doesn't stop the rest
+        results = []
+
+        for offset, buffers in runs:
+            try:
+                written = self.storage.write(offset, buffers)
+
+                if self.fsync == self.FSYNC_BATCH:
+                    self.storage.sync(written)
+
+                results.append(written)
+            except Exception as error:
+                results.append(error)
+
+        return results
+
+    def __batch_done(self, results, runs: list):
+        batch = self.writing
+        self.writing = {}
+
+        if isinstance(results, Failure):
+            results = [results] * len(runs)
+
+        # next batch goes out before anyone hears about this one
+        self.__flush()
+
+        for result, (_, indices, buffers) in zip(results, runs):
+            if isinstance(result, (Exception, Failure)):
+                failure = result if isinstance(result, Failure) else Failure(result)
+
+                for index in indices:
+                    batch[index][1].errback(failure)
+
+                continue
+
+            self.dirty.update(result)
+            self.num_writes += 1
+            self.bytes_written += sum(len(data) for data in buffers)
+
+            for index, data in zip(indices, buffers):
+                self.pieces_written += 1
+
+                if self.cache_pieces:
+                    self.cache.put((self.info_hash, index), data)
+
+                batch[index][1].callback(None)
+
+        if not self.writing and not self.write_queue:
+            waiters, self.drain_waiters = self.drain_waiters, []
+
+            for d in waiters:
+                d.callback(None)
+
+    def read_block(self, index: int, begin: int, length: int) -> defer.Deferred:
+        '''
+        fires with the block's bytes, from the cache when possible
+        '''
+
+        key = (self.info_hash, index)
+        piece = self.cache.get(key)
+
+        if piece is not None:
+            self.cache_hits += 1
+
+            with memoryview(piece) as view:
+                return defer.succeed(bytes(view[begin:begin + length]))
+
+        if not self.cache_pieces:
+            self.cache_misses += 1
+            return self.__queue_read(index * self.piece_length + begin, length)
+
+        d = defer.Deferred()
+
+        # piece is already on its way in - doesn't cost another read, so it counts as a hit
+        if index in self.loading:
+            self.cache_hits += 1
+            self.loading[index].append((d, begin, length))
+            return d
+
+        self.cache_misses += 1
+        self.loading[index] = [(d, begin, length)]
+
+        offset = index * self.piece_length
+        read = self.__queue_read(offset, min(self.piece_length, self.storage.length - offset))
+        read.addCallbacks(self.__piece_loaded, self.__piece_failed,
+                          callbackArgs=(index,), errbackArgs=(index,))
+
+        return d
+
+    def __piece_loaded(self, data: bytes, index: int):
+        self.cache.put((self.info_hash, index), data)
+
+        for d, begin, length in self.loading.pop(index):
+            d.callback(data[begin:begin + length])
+
+    def __piece_failed(self, failure, index: int):
+        for d, _, _ in self.loading.pop(index):
+            d.errback(failure)
+
+    def __queue_read(self, offset: int, length: int) -> defer.Deferred:
+        d = defer.Deferred()
+
+        bisect.insort(self.read_queue, (offset, next(self.sequence), length, d))
+        self.__dispatch_reads()
+
+        return d
+
+    def __dispatch_reads(self):
+        while self.reads_in_flight < self.MAX_READS and self.read_queue:
+            # next read at or past the last one, wrapping back to the start
+            position = bisect.bisect_left(self.read_queue, (self.head,))
+
+            if position == len(self.read_queue):
+                position = 0
+
+            offset, _, length, d = self.read_queue.pop(position)
+            self.head = offset
+            self.reads_in_flight += 1
+
+            read = threads.deferToThreadPool(reactor, self.pool, self.storage.read, offset, length)
+            read.addBoth(self.__read_done, d)
+
+    def __read_done(self, result, d: defer.Deferred):
+        self.reads_in_flight -= 1
+        self.__dispatch_reads()
+
+        if isinstance(result, Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+    def __sync_dirty(self) -> defer.Deferred:
+        dirty, self.dirty = self.dirty, set()
+
+        if not dirty:
+            return defer.succeed(None)
+
+        return threads.deferToThreadPool(reactor, self.pool, self.storage.sync, dirty)
+
+    def write_queue_depth(self) -> int:
+        return len(self.write_queue) + len(self.writing)
+
+    def read_queue_depth(self) -> int:
+        return len(self.read_queue) + self.reads_in_flight
+
+    def cache_hit_rate(self) -> float:
+        lookups = self.cache_hits + self.cache_misses
+
+        if lookups == 0:
+            return 0.0
+
+        return self.cache_hits / lookups
+
+    def average_write_size(self) -> float:
+        if self.num_writes == 0:
+            return 0.0
+
+        return self.bytes_written / self.num_writes
+
+    def drain(self) -> defer.Deferred:
+        '''
+        fires once every write queued so far has landed
+        '''
+
+        if not self.writing and not self.write_queue:
+            return defer.succeed(None)
+
+        d = defer.Deferred()
+        self.drain_waiters.append(d)
+
+        return d
+
+    def close(self) -> defer.Deferred:
+        '''
+        wait for outstanding writes, sync them unless the policy
+        says not to, then close the files
+
+        safe to call more than once, every call fires once the files are closed
+        '''
+
+        if self.closing is None:
+            if self.sync_loop is not None and self.sync_loop.running:
+                self.sync_loop.stop()
+
+            # files that are still being opened get closed once they are
+            self.closing = self.opening or defer.succeed(None)
+            self.closing.addCallback(lambda _: self.drain())
+
+            if self.fsync != self.FSYNC_NEVER:
+                self.closing.addCallback(lambda _: self.__sync_dirty())
+
+            self.closing.addCallback(self.__close_files)
+            self.closing.addBoth(self.__closed)
+
+        # each caller gets its own copy, so callbacks added to one can't
+        # change the result the others see
+        d = defer.Deferred()
+        self.closing.addCallback(self.__pass_on, d)
+
+        return d
+
+    def __closed(self, result):
+        # kept for every caller, a failure is theirs to handle
+        self.close_result = result
+
+    def __pass_on(self, _, d: defer.Deferred):
+        if isinstance(self.close_result, Failure):
+            d.errback(self.close_result)
+        else:
+            d.callback(self.close_result)
+
+    def __close_files(self, _):
+        self.storage.close()
+
+        # leave the room in a shared cache to torrents that are still running
+        for key in [key for key in self.cache.pieces if key[0] == self.info_hash]:
+            self.cache.discard(key)
@@ -3,26 +3,130 @@ from tracker import Tracker
 from metainfo import MetaInfo
 from connection import PeerProtocol, PeerFactory
 from models.piece import Piece
-from twisted.internet.endpoints import TCP4ClientEndpoint, TCP4ServerEndpoint
+from metrics import MetricsRegistry, ReactorLagMonitor, serve_metrics
+from profiling import SamplingProfiler, ReactorWatchdog
+from disk_scheduler import DiskScheduler
+from utils.piece_cache import PieceCache
+from twisted.internet.endpoints import TCP4ServerEndpoint
 from twisted.internet import reactor
-from twisted.internet.endpoints import connectProtocol
+from twisted.internet.error import CannotListenError
+import argparse
+import cProfile
 
-def start_server(tracker: Tracker, meta_info: MetaInfo):
-    endpoint = TCP4ServerEndpoint(reactor, 8000)
-    factory = PeerFactory(tracker.peers, meta_info, tracker.peer_id)
+# local port the metrics can be read from (/metrics or /metrics.json)
+METRICS_PORT = 6880
+
+def start_server(tracker: Tracker, meta_info: MetaInfo, metrics: MetricsRegistry = None, args = None):
+    endpoint = TCP4ServerEndpoint(reactor, tracker.port)
+    factory = PeerFactory(tracker.peers, meta_info, tracker.peer_id, metrics=metrics,
+                          **rate_limits(args), **disk_options(args))
     endpoint.listen(factory)
 
-    for peer in tracker.peers:
-        client = TCP4ClientEndpoint(reactor, peer.host, int(peer.port))
-        d = connectProtocol(client, PeerProtocol(factory, peer))
-        d.addCallback(connected_protocol)
-        d.addErrback(error_handle)
+    # once the files on disk have been checked, connections start as soon
+    # as the first tracker answers, and are opened a few at a time rather
+    # than all at once - trackers keep being re-announced to for as long
+    # as the client runs
+    d = factory.ready
+    d.addCallback(start_tracker, tracker, factory)
+    d.addErrback(tracker_error)
+
+def start_tracker(_, tracker: Tracker, factory: PeerFactory):
+    # shut down before the files were checked
+    if factory.stopped:
+        return
+
+    return tracker.start(factory)
+
+def rate_limits(args) -> dict:
+    '''
+    rate limit options (KiB/s) as PeerFactory arguments (bytes/s)
+    '''
+
+    if args is None:
+        return {}
+
+    return {'max_download_rate' : args.download_limit * 1024,
+            'max_upload_rate' : args.upload_limit * 1024,
+            'peer_download_rate' : args.peer_download_limit * 1024,
+            'peer_upload_rate' : args.peer_upload_limit * 1024}
+
+def disk_options(args) -> dict:
+    if args is None:
+        return {}
+
+    return {'disk_cache' : PieceCache(args.cache_size * 2**20),
+            'fsync' : args.fsync}
+
+def tracker_error(failure):
+    # trackers are retried in the background, so keep going
+    print("\nCouldn't get any peers: %s (retrying)" % failure.getErrorMessage())
+
+def start_metrics(metrics: MetricsRegistry, watchdog_threshold: float):
+    monitor = ReactorLagMonitor(metrics)
+    monitor.start()
+
+    # logs where the reactor is stuck whenever it falls behind
+    ReactorWatchdog(monitor, watchdog_threshold).start()
+
+    try:
+        serve_metrics(metrics, METRICS_PORT)
+        print("\nMetrics available at http://127.0.0.1:%d/metrics" % METRICS_PORT)
+    except CannotListenError:
+        print("\nCouldn't serve metrics, port %d is in use" % METRICS_PORT)
 
-def connected_protocol(protocol):
-    protocol.send_handshake()
+def run_reactor(profile: str | None, profile_mode: str):
+    '''
+    run the reactor, under a profiler if asked to - sampling writes
+    folded stacks (for flame graphs), cprofile writes pstats
+    '''
 
-def error_handle(error):
-    pass
+    if profile is None:
+        reactor.run()
+        return
+
+    if profile_mode == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.runcall(reactor.run)
+        profiler.dump_stats(profile)
+    else:
+        profiler = SamplingProfiler()
+        profiler.start()
+
+        try:
+            reactor.run()
+        finally:
+            profiler.stop()
+            profiler.write(profile)
+
+    print("Profile written to %s" % profile)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Peer2Peer BitTorrent client")
+
+    parser.add_argument('torrent', nargs='?', help="torrent file (asked for if not given)")
+    parser.add_argument('--profile', nargs='?', const='profile.folded', metavar='PATH',
+                        help="profile the run and write the results to PATH on exit")
+    parser.add_argument('--profile-mode', choices=['sample', 'cprofile'], default='sample',
+                        help="sampling profiler (folded stacks for flame graphs) or cProfile (pstats)")
+    parser.add_argument('--watchdog-threshold', type=float, default=ReactorWatchdog.THRESHOLD,
+                        help="seconds the reactor can be blocked before its stack is logged")
+
+    parser.add_argument('--cache-size', type=int, default=DiskScheduler.CACHE_SIZE // 2**20, metavar='MIB',
+                        help="memory for caching pieces that get uploaded")
+    parser.add_argument('--fsync', choices=DiskScheduler.FSYNC_POLICIES, default=DiskScheduler.FSYNC_CLOSE,
+                        help="when written data is flushed to the disk")
+
+    # 0 means no limit
+    parser.add_argument('--download-limit', type=int, default=0, metavar='KIB/S',
+                        help="max download rate overall")
+    parser.add_argument('--upload-limit', type=int, default=0, metavar='KIB/S',
+                        help="max upload rate overall")
+    parser.add_argument('--peer-download-limit', type=int, default=0, metavar='KIB/S',
+                        help="max download rate from each peer")
+    parser.add_argument('--peer-upload-limit', type=int, default=0, metavar='KIB/S',
+                        help="max upload rate to each peer")
+
+    return parser.parse_args()
 
 def print_info(meta_info: MetaInfo, tracker: Tracker):
     print("\nTorrent File Name: %s" % meta_info.file_name)
@@ -30,7 +134,7 @@ def print_info(meta_info: MetaInfo, tracker: Tracker):
     print("Piece Length: %d" % meta_info.piece_length)
     print("Last Piece Length: %d" % meta_info.last_piece_length)
     print("Total # of Bytes: %d" % meta_info.length)
-    print("Number of Peers: %d" % len(tracker.peers))
+    print("Number of Trackers: %d" % sum(len(tier.trackers) for tier in tracker.tiers))
 
     print("\nFile names and their sizes:")
     if meta_info.multi_files:
@@ -40,10 +144,15 @@ def print_info(meta_info: MetaInfo, tracker: Tracker):
         print(" - '%s' (%d bytes)" % (meta_info.name, meta_info.length))
 
 if __name__ == "__main__":
-    print("To use the Peer2Peer client, please type in the name of your torrent file!")
-    print("(you're not required to type the '.torrent' part)")
+    args = parse_args()
+
+    torrent_file = args.torrent
+
+    if torrent_file is None:
+        print("To use the Peer2Peer client, please type in the name of your torrent file!")
+        print("(you're not required to type the '.torrent' part)")
 
-    torrent_file = input().strip()
+        torrent_file = input().strip()
 
     if not torrent_file.endswith('.torrent'):
         torrent_file += '.torrent'
@@ -51,11 +160,12 @@ if __name__ == "__main__":
     meta_info = MetaInfo(torrent_file)
     meta_info.parse_file()
 
-    tracker = Tracker(meta_info)
-    tracker.fetch_peers()
+    metrics = MetricsRegistry()
+    tracker = Tracker(meta_info, metrics=metrics)
 
     print_info(meta_info, tracker)
 
-    start_server(tracker, meta_info)
+    start_server(tracker, meta_info, metrics, args)
+    start_metrics(metrics, args.watchdog_threshold)
 
-    reactor.run()
\ No newline at end of file
+    run_reactor(args.profile, args.profile_mode)
\ No newline at end of file
@@ -1,7 +1,7 @@
-from utils.bencoding import Decoder, Encoder
+from utils.bencoding import Decoder
 import hashlib
 import urllib.parse
-from models.piece import Piece
+from models.piece_table import PieceTable
 
 class MetaInfo:
     def __init__(self, file_name: str):
@@ -9,7 +9,13 @@ class MetaInfo:
         self.multi_files = False
 
         with open(file_name, 'rb') as file:
-            self.file_contents = Decoder(file.read()).decode()
+            self.raw_contents = file.read()
+
+        decoder = Decoder(self.raw_contents)
+        self.file_contents = decoder.decode()
+
+        # where the info dict sits in the file, it's hashed as is
+        self.info_span = decoder.spans.get(b'info')
 
     def parse_file(self):
         '''
@@ -25,8 +31,13 @@ class MetaInfo:
 
         self.info = self.file_contents[b'info']
 
-        # info hash will be used for tracker later on
-        self.info_hash = hashlib.sha1(Encoder().encode(self.info)).digest()
+        # info hash will be used for tracker later on - it's taken over the
+        # exact bytes in the file, re-encoding could change them (and copies
+        # the whole pieces string)
+        start, end = self.info_span
+
+        with memoryview(self.raw_contents)[start:end] as info_bytes:
+            self.info_hash = hashlib.sha1(info_bytes).digest()
 
         # check for all optional contents
         if b'announce-list' in self.file_contents:
@@ -62,19 +73,5 @@ class MetaInfo:
 
         self.last_piece_length = self.length - (self.piece_length * (self.num_pieces - 1))
 
-        # create list of Piece objects
-        self.pieces = []
-        
-        # SHA1 hashes of length 20 for each piece
-        for i in range(0, len(self.info[b'pieces']), 20):
-            if i + 20 >= len(self.info[b'pieces']):
-                is_final_piece = True
-                piece_length = self.last_piece_length
-            else:
-                is_final_piece = False
-                piece_length = self.piece_length
-
-            piece_hash = self.info[b'pieces'][i:i+20]
-            index = i // 20
-
-            self.pieces.append(Piece(index, piece_hash, piece_length, is_final_piece))
\ No newline at end of file
+        # every piece's hash and length, straight out of the pieces string
+        self.pieces = PieceTable(self.info[b'pieces'], self.piece_length, self.length)
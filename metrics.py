@@ -0,0 +1,217 @@
+from twisted.internet import reactor
+from twisted.web import server, resource
+import json
+import time
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+    def samples(self) -> list:
+        return [(self.name, {}, self.value)]
+
+class Gauge:
+    def __init__(self, name: str, help: str, func=None, labels: tuple = ()):
+        '''
+        func is called whenever the metrics are read, so values that
+        already live somewhere (rate meters, queue lengths) cost nothing
+        to keep up to date - with labels it returns {label values: value}
+        '''
+
+        self.name = name
+        self.help = help
+        self.func = func
+        self.labels = labels
+        self.value = 0
+
+    def set(self, value: float):
+        self.value = value
+
+    def samples(self) -> list:
+        if self.func is None:
+            return [(self.name, {}, self.value)]
+
+        value = self.func()
+
+        if not self.labels:
+            return [(self.name, {}, value)]
+
+        return [(self.name, dict(zip(self.labels, label_values)), sample)
+                for label_values, sample in value.items()]
+
+class Timer:
+    def __init__(self, name: str, help: str):
+        '''
+        running count, total and max of how long something takes
+        (in seconds) - no buckets, so recording one is just a few adds
+        '''
+
+        self.name = name
+        self.help = help
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+
+        if seconds > self.max:
+            self.max = seconds
+
+    def average(self) -> float:
+        if self.count == 0:
+            return 0.0
+
+        return self.total / self.count
+
+    def samples(self) -> list:
+        return [(self.name + '_count', {}, self.count),
+                (self.name + '_sum', {}, self.total),
+                (self.name + '_max', {}, self.max)]
+
+class MetricsRegistry:
+    def __init__(self):
+        '''
+        every counter, gauge and timer the client keeps, readable as
+        Prometheus text or JSON
+
+        names are registered once, asking for an existing name
+        returns the metric that's already there
+        '''
+
+        self.metrics = {}
+
+    def __register(self, metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self.__register(Counter(name, help))
+
+    def gauge(self, name: str, help: str, func=None, labels: tuple = ()) -> Gauge:
+        return self.__register(Gauge(name, help, func, labels))
+
+    def timer(self, name: str, help: str) -> Timer:
+        return self.__register(Timer(name, help))
+
+    def to_prometheus(self) -> str:
+        '''
+        docs for the text format
+        https://prometheus.io/docs/instrumenting/exposition_formats/
+        '''
+
+        lines = []
+
+        for metric in self.metrics.values():
+            samples = metric.samples()
+
+            if isinstance(metric, Timer):
+                # count and sum make a summary, max goes on its own
+                lines.append('# HELP %s %s' % (metric.name, metric.help))
+                lines.append('# TYPE %s summary' % metric.name)
+                lines.extend(self.__format_samples(samples[:2]))
+                lines.append('# TYPE %s_max gauge' % metric.name)
+                lines.extend(self.__format_samples(samples[2:]))
+                continue
+
+            kind = 'counter' if isinstance(metric, Counter) else 'gauge'
+
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, kind))
+            lines.extend(self.__format_samples(samples))
+
+        return '\n'.join(lines) + '\n'
+
+    def __format_samples(self, samples: list) -> list:
+        lines = []
+
+        for name, labels, value in samples:
+            if labels:
+                label_text = ','.join('%s="%s"' % (key, str(label).replace('"', '\\"'))
+                                      for key, label in labels.items())
+                lines.append('%s{%s} %s' % (name, label_text, value))
+            else:
+                lines.append('%s %s' % (name, value))
+
+        return lines
+
+    def to_dict(self) -> dict:
+        result = {}
+
+        for metric in self.metrics.values():
+            for name, labels, value in metric.samples():
+                if labels:
+                    key = ','.join(str(label) for label in labels.values())
+                    result.setdefault(name, {})[key] = value
+                else:
+                    result[name] = value
+
+        return result
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, registry: MetricsRegistry):
+        '''
+        /metrics gives Prometheus text, /metrics.json gives JSON
+        '''
+
+        super().__init__()
+        self.registry = registry
+
+    def render_GET(self, request):
+        if request.path.endswith(b'.json'):
+            request.setHeader('Content-Type', 'application/json')
+            return self.registry.to_json().encode()
+
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.registry.to_prometheus().encode()
+
+def serve_metrics(registry: MetricsRegistry, port: int, interface: str = '127.0.0.1'):
+    return reactor.listenTCP(port, server.Site(MetricsResource(registry)), interface=interface)
+
+class ReactorLagMonitor:
+    # seconds between checks
+    INTERVAL = 0.5
+
+    def __init__(self, registry: MetricsRegistry):
+        '''
+        schedules a call every INTERVAL seconds and measures how late it
+        runs - anything blocking the reactor (a slow handler, disk I/O
+        on the reactor thread) shows up as lag
+        '''
+
+        self.lag = registry.timer('reactor_lag_seconds', 'How late timed calls run on the reactor')
+        self.last_lag = registry.gauge('reactor_last_lag_seconds', 'Lag at the last check')
+
+        self.expected = None
+        self.timer = None
+
+    def start(self):
+        self.__schedule()
+
+    def stop(self):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+
+    def __schedule(self):
+        # rescheduled from each check (rather than a LoopingCall, which
+        # skips missed calls) so every check is exactly INTERVAL after the last
+        self.expected = time.monotonic() + self.INTERVAL
+        self.timer = reactor.callLater(self.INTERVAL, self.check)
+
+    def check(self):
+        lag = max(0.0, time.monotonic() - self.expected)
+
+        self.lag.observe(lag)
+        self.last_lag.set(lag)
+
+        self.__schedule()
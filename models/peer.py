@@ -1,11 +1,24 @@
 class Peer:
     '''
     simple class for Peer objects
+
+    trackers can hand over thousands of these, so they use
+    slots rather than carrying a __dict__ around each
     '''
 
-    def __init__(self, host: str, port: str):
+    __slots__ = ('host', 'port', 'info_hash', 'peer_id')
+
+    def __init__(self, host: str, port: int):
         self.host = host
         self.port = port
 
         self.info_hash = None
-        self.peer_id = None
\ No newline at end of file
+        self.peer_id = None
+
+    @property
+    def address(self) -> tuple:
+        '''
+        (host, port) - what peers are told apart by
+        '''
+
+        return (self.host, self.port)
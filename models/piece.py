@@ -1,15 +1,21 @@
-import math
-
 class Piece:
+    '''
+    view of one piece from the PieceTable, only made
+    when a piece actually starts downloading
+    '''
+
     BLOCK_SIZE = 2**14
 
-    def __init__(self, index: int, piece_hash: bytes, length: int, is_final: bool):
+    __slots__ = ('index', 'hash', 'length', 'is_final', 'num_blocks', 'final_block_size')
+
+    def __init__(self, index: int, piece_hash, length: int, is_final: bool):
         self.index = index
         self.hash = piece_hash
         self.length = length
         self.is_final = is_final
 
-        self.num_blocks = math.ceil(self.length / self.BLOCK_SIZE)
+        # ceil without going through floats
+        self.num_blocks = -(-self.length // self.BLOCK_SIZE)
 
         self.final_block_size = self.length - ((self.num_blocks - 1) * self.BLOCK_SIZE)
 
@@ -31,4 +37,4 @@ class Piece:
         return block_index == self.num_blocks - 1
     
     def is_downloaded(self, block_index: int) -> bool:
-        return block_index >= self.num_blocks
\ No newline at end of file
+        return block_index >= self.num_blocks
@@ -0,0 +1,75 @@
+from models.piece import Piece
+
+class PieceDownload:
+    '''
+    a piece that's partway through being downloaded - blocks
+    are copied straight into one buffer the size of the piece
+    as they arrive, in whatever order that happens to be
+    '''
+
+    def __init__(self, piece: Piece):
+        self.piece = piece
+        self.index = piece.index
+        self.data = bytearray(piece.length)
+
+        # blocks nobody has been asked for yet, popped from the end
+        # so they're requested in order
+        self.unrequested = list(range(piece.num_blocks - 1, -1, -1))
+
+        self.received = bytearray(piece.num_blocks)
+        self.num_received = 0
+
+        # block index -> peer that sent it, in case the piece turns out bad
+        self.senders = {}
+
+    def has_unrequested(self) -> bool:
+        return len(self.unrequested) > 0
+
+    def next_block(self) -> tuple:
+        '''
+        returns (begin, length) of the next block to request
+        '''
+
+        block_index = self.unrequested.pop()
+
+        return (block_index * Piece.BLOCK_SIZE, self.piece.get_block_size(block_index))
+
+    def return_block(self, begin: int):
+        '''
+        block was requested but never arrived (peer choked
+        us or left) so someone else needs to be asked
+        '''
+
+        block_index = begin // Piece.BLOCK_SIZE
+
+        if not self.received[block_index] and block_index not in self.unrequested:
+            self.unrequested.append(block_index)
+
+    def add_block(self, begin: int, block, peer=None) -> bool:
+        '''
+        copy block into the piece, returns False if it's
+        not a block we're expecting or it's a duplicate
+        '''
+
+        block_index, remainder = divmod(begin, Piece.BLOCK_SIZE)
+
+        if (remainder != 0
+            or block_index >= self.piece.num_blocks
+            or len(block) != self.piece.get_block_size(block_index)
+            or self.received[block_index]):
+            return False
+
+        self.data[begin:begin + len(block)] = block
+        self.received[block_index] = 1
+        self.num_received += 1
+        self.senders[block_index] = peer
+
+        return True
+
+    def is_complete(self) -> bool:
+        return self.num_received == self.piece.num_blocks
+
+    def get_block(self, block_index: int) -> memoryview:
+        begin = block_index * Piece.BLOCK_SIZE
+
+        return memoryview(self.data)[begin:begin + self.piece.get_block_size(block_index)]
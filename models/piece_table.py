@@ -0,0 +1,64 @@
+from models.piece import Piece
+
+class PieceTable:
+    HASH_SIZE = 20
+
+    def __init__(self, hashes: bytes, piece_length: int, total_length: int):
+        '''
+        every piece of the torrent, without an object per piece
+
+        hashes stay in the buffer they came in (the info dict's pieces
+        string) and are sliced out through a memoryview, lengths and
+        block counts are worked out from the piece length since only
+        the last piece can differ - Piece views are handed out on demand
+        '''
+
+        self.hashes = memoryview(hashes)
+        self.num_pieces = len(hashes) // self.HASH_SIZE
+        self.piece_length = piece_length
+        self.last_piece_length = total_length - piece_length * (self.num_pieces - 1)
+
+        self.blocks_per_piece = -(-piece_length // Piece.BLOCK_SIZE)
+        self.last_piece_blocks = -(-self.last_piece_length // Piece.BLOCK_SIZE)
+
+    def __len__(self) -> int:
+        return self.num_pieces
+
+    def __getitem__(self, index: int) -> Piece:
+        if not 0 <= index < self.num_pieces:
+            raise IndexError('Piece index out of range')
+
+        return Piece(index, self.get_hash(index), self.get_length(index), self.is_final(index))
+
+    def __iter__(self):
+        for index in range(self.num_pieces):
+            yield self[index]
+
+    def is_final(self, index: int) -> bool:
+        return index == self.num_pieces - 1
+
+    def get_hash(self, index: int) -> memoryview:
+        offset = index * self.HASH_SIZE
+
+        return self.hashes[offset:offset + self.HASH_SIZE]
+
+    def is_equal_hash(self, index: int, hash: bytes) -> bool:
+        return self.get_hash(index) == hash
+
+    def get_length(self, index: int) -> int:
+        if index == self.num_pieces - 1:
+            return self.last_piece_length
+
+        return self.piece_length
+
+    def get_num_blocks(self, index: int) -> int:
+        if index == self.num_pieces - 1:
+            return self.last_piece_blocks
+
+        return self.blocks_per_piece
+
+    def get_block_size(self, index: int, block_index: int) -> int:
+        if block_index == self.get_num_blocks(index) - 1:
+            return self.get_length(index) - block_index * Piece.BLOCK_SIZE
+
+        return Piece.BLOCK_SIZE
@@ -0,0 +1,23 @@
+class Torrent:
+    '''
+    everything a session keeps for one torrent - the parsed
+    metainfo, its trackers and the factory running its peers
+    '''
+
+    __slots__ = ('meta_info', 'tracker', 'factory', 'path')
+
+    def __init__(self, meta_info, tracker, factory, path: str):
+        self.meta_info = meta_info
+        self.tracker = tracker
+        self.factory = factory
+
+        # .torrent file it was loaded from
+        self.path = path
+
+    @property
+    def info_hash(self) -> bytes:
+        return self.meta_info.info_hash
+
+    @property
+    def name(self) -> str:
+        return self.meta_info.name
@@ -0,0 +1,23 @@
+class TrackerTier:
+    '''
+    a tier of trackers from the announce list, along
+    with when it should next be announced to
+    '''
+
+    def __init__(self, trackers: list):
+        self.trackers = trackers
+
+        # set from the last answer (seconds)
+        self.interval = None
+        self.min_interval = None
+
+        self.last_announce = None
+        self.failures = 0
+        self.answered = False
+
+        # 'started' or 'completed' if it hasn't got through to this
+        # tier yet - every retry carries it until the tier answers
+        self.event = ''
+
+        # DelayedCall for the next announce
+        self.timer = None
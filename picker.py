@@ -0,0 +1,181 @@
+import random
+
+class PiecePicker:
+    DEFAULT_PRIORITY = 1
+
+    def __init__(self, num_pieces: int):
+        '''
+        keeps count of how many peers have each piece so that the
+        rarest pieces get requested first
+
+        every piece we still want sits in a bucket keyed by its
+        priority and availability - picking walks the buckets from
+        highest priority and lowest availability, so it only has to
+        look at pieces that are about as rare as the rarest one
+
+        each bucket is kept in a random order, so scanning it from
+        the front gives a random tiebreak between equally rare pieces
+
+        peers that have every piece (seeds) are counted separately,
+        they add the same amount to every piece so they never change
+        which piece is the rarest
+        '''
+
+        self.num_pieces = num_pieces
+        self.seeds = 0
+
+        # number of (non-seed) peers that have each piece
+        self.availability = [0] * num_pieces
+        self.priorities = [self.DEFAULT_PRIORITY] * num_pieces
+
+        # priority -> list of buckets indexed by availability
+        self.buckets = {}
+
+        # where each wanted piece sits in its bucket, None if it isn't wanted
+        self.positions = [None] * num_pieces
+        self.num_wanted = 0
+
+        for index in range(num_pieces):
+            self.__insert(index)
+
+    def __get_bucket(self, index: int) -> list:
+        buckets = self.buckets.setdefault(self.priorities[index], [])
+        availability = self.availability[index]
+
+        while len(buckets) <= availability:
+            buckets.append([])
+
+        return buckets[availability]
+
+    def __insert(self, index: int):
+        '''
+        add piece to a random spot in its bucket
+        '''
+
+        bucket = self.__get_bucket(index)
+        position = random.randint(0, len(bucket))
+
+        bucket.append(index)
+
+        # swap the piece that was there to the end
+        if position < len(bucket) - 1:
+            moved = bucket[position]
+            bucket[position] = index
+            bucket[-1] = moved
+            self.positions[moved] = len(bucket) - 1
+
+        self.positions[index] = position
+        self.num_wanted += 1
+
+    def __remove(self, index: int):
+        bucket = self.__get_bucket(index)
+        position = self.positions[index]
+
+        # fill the gap with the last piece rather than shifting everything
+        last = bucket.pop()
+
+        if last != index:
+            bucket[position] = last
+            self.positions[last] = position
+
+        self.positions[index] = None
+        self.num_wanted -= 1
+
+    def __update_availability(self, index: int, change: int):
+        wanted = self.positions[index] is not None
+
+        if wanted:
+            self.__remove(index)
+
+        self.availability[index] += change
+
+        if wanted:
+            self.__insert(index)
+
+    def is_wanted(self, index: int) -> bool:
+        return self.positions[index] is not None
+
+    def get_availability(self, index: int) -> int:
+        return self.availability[index] + self.seeds
+
+    def add_have(self, index: int):
+        self.__update_availability(index, 1)
+
+    def remove_have(self, index: int):
+        self.__update_availability(index, -1)
+
+    def add_pieces(self, indices):
+        '''
+        used when a peer sends its bitfield
+        '''
+
+        for index in indices:
+            self.__update_availability(index, 1)
+
+    def remove_pieces(self, indices):
+        '''
+        used when a peer disconnects
+        '''
+
+        for index in indices:
+            self.__update_availability(index, -1)
+
+    def add_seed(self):
+        self.seeds += 1
+
+    def remove_seed(self):
+        self.seeds -= 1
+
+    def set_priority(self, index: int, priority: int):
+        '''
+        pieces with a higher priority are always picked before
+        pieces with a lower one, no matter how rare they are
+        '''
+
+        wanted = self.positions[index] is not None
+
+        if wanted:
+            self.__remove(index)
+
+        self.priorities[index] = priority
+
+        if wanted:
+            self.__insert(index)
+
+    def pick(self, bitfield, is_seed: bool = False) -> int | None:
+        '''
+        pick the rarest wanted piece that the peer has and stop
+        tracking it as wanted (it's now being downloaded)
+
+        pieces no regular peer has can only be picked from seeds
+        '''
+
+        start = 0 if is_seed else 1
+
+        for priority in sorted(self.buckets, reverse=True):
+            buckets = self.buckets[priority]
+
+            for availability in range(start, len(buckets)):
+                for index in buckets[availability]:
+                    if is_seed or bitfield[index]:
+                        self.__remove(index)
+                        return index
+
+        return None
+
+    def release(self, index: int):
+        '''
+        piece wasn't finished (peer left, data failed to write, etc.)
+        so it needs to be picked again
+        '''
+
+        if self.positions[index] is None:
+            self.__insert(index)
+
+    def discard(self, index: int):
+        '''
+        piece doesn't need to be picked anymore
+        '''
+
+        if self.positions[index] is not None:
+            self.__remove(index)
@@ -0,0 +1,134 @@
+from metrics import ReactorLagMonitor
+from collections import Counter
+import threading
+import traceback
+import sys
+import os
+import time
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+class SamplingProfiler:
+    # seconds between samples
+    INTERVAL = 0.005
+
+    def __init__(self, interval: float = INTERVAL):
+        '''
+        grabs the stack of every thread every few milliseconds from a
+        background thread - nothing is hooked into the code being run,
+        so it's cheap enough to use on a real download
+
+        stacks are written in the folded format (one 'frame;frame;frame
+        count' line per distinct stack), which flamegraph.pl, speedscope
+        and most other flame graph tools read directly
+        '''
+
+        self.interval = interval
+        self.stacks = Counter()
+        self.num_samples = 0
+
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.__run, name='sampling-profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+        if self.thread is not None:
+            self.thread.join()
+
+    def __run(self):
+        own_id = threading.get_ident()
+
+        while self.running:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+
+                stack = []
+
+                while frame is not None:
+                    stack.append(frame_label(frame))
+                    frame = frame.f_back
+
+                # root first, split up by thread so the reactor stands apart from workers
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+            self.num_samples += 1
+            time.sleep(self.interval)
+
+    def write(self, path: str):
+        with open(path, 'w') as file:
+            for stack, count in self.stacks.most_common():
+                file.write('%s %d\n' % (stack, count))
+
+class ReactorWatchdog:
+    # seconds of lag before the reactor's stack gets logged
+    THRESHOLD = 1.0
+
+    def __init__(self, monitor: ReactorLagMonitor, threshold: float = THRESHOLD):
+        '''
+        watches the lag monitor from a separate thread - when its next
+        check is more than threshold seconds overdue the reactor is stuck
+        on something, so the reactor thread's stack is logged while it's
+        still stuck (once the check finally runs it's too late to see why)
+        '''
+
+        self.monitor = monitor
+        self.threshold = threshold
+
+        self.reactor_thread = None
+        # the check we already logged a stall for
+        self.reported = None
+        self.num_stalls = 0
+
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        # has to be started from the reactor's thread
+        self.reactor_thread = threading.get_ident()
+        self.running = True
+
+        self.thread = threading.Thread(target=self.__run, name='reactor-watchdog', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def __run(self):
+        while self.running:
+            time.sleep(self.threshold / 4)
+
+            expected = self.monitor.expected
+
+            if expected is None or expected == self.reported:
+                continue
+
+            lag = time.monotonic() - expected
+
+            if lag > self.threshold:
+                self.reported = expected
+                self.num_stalls += 1
+                self.__log_stack(lag)
+
+    def __log_stack(self, lag: float):
+        frame = sys._current_frames().get(self.reactor_thread)
+
+        if frame is None:
+            return
+
+        stack = ''.join(traceback.format_stack(frame))
+
+        print("\nReactor has been blocked for %.2f seconds, it's currently at:\n%s" % (lag, stack),
+              file=sys.stderr)
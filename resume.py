@@ -0,0 +1,224 @@
+from metainfo import MetaInfo
+from storage import Storage
+from utils.bencoding import Decoder, Encoder
+from utils.bitfield import Bitfield
+from twisted.internet import reactor, threads, defer
+from twisted.python.threadpool import ThreadPool
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import hashlib
+import mmap
+import os
+
+def hash_pieces(files: list, piece_length: int, hashes: bytes, start: int, end: int) -> list:
+    '''
+    runs in a worker process - checks pieces [start, end) of the
+    files on disk against their hashes (only the hashes for those
+    pieces are passed in), reading through mmap so nothing gets
+    copied into Python bytes
+
+    returns the indices of the pieces that match
+    '''
+
+    total_length = sum(length for _, _, length in files)
+    maps = {}
+    valid = []
+
+    try:
+        for index in range(start, end):
+            piece_start = index * piece_length
+            piece_end = min(piece_start + piece_length, total_length)
+            sha1 = hashlib.sha1()
+            complete = True
+
+            for file_index, (path, file_start, file_len) in enumerate(files):
+                file_end = file_start + file_len
+
+                if file_end <= piece_start or file_len == 0:
+                    continue
+                if file_start >= piece_end:
+                    break
+
+                if file_index not in maps:
+                    maps[file_index] = map_file(path)
+
+                file_map = maps[file_index]
+                begin = max(piece_start, file_start) - file_start
+                stop = min(piece_end, file_end) - file_start
+
+                # file is missing or shorter than it should be
+                if file_map is None or len(file_map) < stop:
+                    complete = False
+                    break
+
+                with memoryview(file_map)[begin:stop] as view:
+                    sha1.update(view)
+
+            offset = (index - start) * 20
+
+            if complete and sha1.digest() == hashes[offset:offset + 20]:
+                valid.append(index)
+    finally:
+        for file_map in maps.values():
+            if file_map is not None:
+                file_map.close()
+
+    return valid
+
+def map_file(path: str) -> mmap.mmap | None:
+    try:
+        with open(path, 'rb') as file:
+            # empty files can't be mapped (and have nothing to check)
+            if os.fstat(file.fileno()).st_size == 0:
+                return None
+
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except OSError:
+        return None
+
+class ResumeData:
+    # one thread checking files for every torrent in the process, so checks
+    # run one at a time (each already uses every core) and stay out of the
+    # reactor's pool, which piece hashing and tracker lookups rely on
+    check_pool = None
+
+    # checks waiting their turn queue up here rather than in the pool, so
+    # shutting down only waits on the one that's running
+    check_lock = defer.DeferredLock()
+
+    def __init__(self, meta_info: MetaInfo, storage: Storage):
+        '''
+        remembers which pieces are already on disk between runs
+
+        the resume file is bencoded and keyed by info hash, it holds
+        the bitfield of pieces that were written along with the size
+        and modification time of every file when it was saved - if the
+        files don't match that anymore, the pieces on disk are checked
+        against their hashes instead
+        '''
+
+        self.meta_info = meta_info
+        self.storage = storage
+        self.num_pieces = meta_info.num_pieces
+
+        self.path = os.path.join(storage.directory,
+                                 '.resume',
+                                 meta_info.info_hash.hex() + '.resume')
+
+    def __get_file_stats(self) -> list | None:
+        '''
+        [size, mtime] for every file, None if any are missing
+        '''
+
+        stats = []
+
+        for path, _, _ in self.storage.files:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return None
+
+            stats.append([stat.st_size, stat.st_mtime_ns])
+
+        return stats
+
+    def load(self) -> defer.Deferred:
+        '''
+        fires with the indices of every piece that's already on disk,
+        hashing the files can take minutes so it's done off the reactor thread
+        '''
+
+        stats = self.__get_file_stats()
+
+        # fresh download, nothing to check
+        if stats is None and not any(os.path.exists(path) for path, _, _ in self.storage.files):
+            return defer.succeed([])
+
+        try:
+            with open(self.path, 'rb') as file:
+                resume = Decoder(file.read()).decode()
+
+            if (resume[b'info hash'] == self.meta_info.info_hash
+                and resume[b'files'] == stats
+                and len(resume[b'pieces']) == (self.num_pieces + 7) // 8):
+                pieces = Bitfield.from_bytes(resume[b'pieces'], self.num_pieces)
+                return defer.succeed(list(pieces.indices()))
+        except (OSError, KeyError, ValueError, TypeError, EOFError):
+            # missing or unreadable resume file - fall back to hashing
+            pass
+
+        return self.check_lock.run(threads.deferToThreadPool, reactor,
+                                   self.get_check_pool(), self.check_files)
+
+    @classmethod
+    def get_check_pool(cls) -> ThreadPool:
+        if cls.check_pool is None:
+            cls.check_pool = ThreadPool(0, 1, 'check')
+            reactor.callWhenRunning(cls.check_pool.start)
+            reactor.addSystemEventTrigger('during', 'shutdown', cls.check_pool.stop)
+
+        return cls.check_pool
+
+    def check_files(self, workers: int = None) -> list:
+        '''
+        hash whatever is on disk against the piece hashes,
+        split across a process pool so every core gets used
+
+        blocks until every piece is checked - workers are spawned rather
+        than forked, as forking a process that already runs threads (disk
+        I/O, the watchdog) can leave the children holding locks nobody releases
+        '''
+
+        print("\nChecking existing files against piece hashes...")
+
+        workers = workers or os.cpu_count() or 1
+        hashes = self.meta_info.info[b'pieces']
+
+        # a few chunks per worker so they finish around the same time
+        chunk = max(1, self.num_pieces // (workers * 4))
+        valid = []
+
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = []
+
+            for start in range(0, self.num_pieces, chunk):
+                end = min(start + chunk, self.num_pieces)
+
+                futures.append(executor.submit(hash_pieces,
+                                               self.storage.files,
+                                               self.meta_info.piece_length,
+                                               hashes[start * 20:end * 20],
+                                               start,
+                                               end))
+
+            for future in futures:
+                valid.extend(future.result())
+
+        return valid
+
+    def save(self, pieces: Bitfield):
+        '''
+        should only be called once every write for the
+        given pieces has landed on disk
+        '''
+
+        stats = self.__get_file_stats()
+
+        if stats is None:
+            return
+
+        # keys in sorted order, as bencoding expects
+        resume = {b'files' : stats,
+                  b'info hash' : self.meta_info.info_hash,
+                  b'pieces' : pieces.tobytes()}
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        # write to a temporary file first so a crash can't leave a half-written one
+        temp_path = self.path + '.tmp'
+
+        with open(temp_path, 'wb') as file:
+            file.write(Encoder().encode(resume))
+
+        os.replace(temp_path, self.path)
@@ -0,0 +1,288 @@
+from metainfo import MetaInfo
+from tracker import Tracker, generate_peer_id
+from connection import PeerFactory
+from connection_manager import ConnectionManager, ConnectionBudget
+from models.torrent import Torrent
+from metrics import MetricsRegistry
+from utils.token_bucket import TokenBucket
+from utils.piece_cache import PieceCache
+from twisted.internet.protocol import Protocol, Factory
+from twisted.internet import reactor, defer
+from twisted.python.threadpool import ThreadPool
+import struct
+import os
+
+class HandshakeRouter(Protocol):
+    # bytes of the handshake needed to get to the info hash
+    # (pstrlen, pstr, reserved)
+    HEADER_LENGTH = 48
+
+    def __init__(self, session):
+        '''
+        incoming connections don't say which torrent they're for until
+        the handshake arrives, so this reads just enough of it to find
+        the torrent and then hands the connection over to a PeerProtocol
+        of that torrent's factory
+        '''
+
+        self.session = session
+        self.buffer = bytearray()
+        self.timer = None
+
+    def connectionMade(self):
+        self.timer = reactor.callLater(ConnectionManager.HANDSHAKE_TIMEOUT, self.transport.loseConnection)
+
+    def connectionLost(self, reason):
+        self.__cancel_timer()
+
+    def __cancel_timer(self):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+
+        self.timer = None
+
+    def dataReceived(self, data: bytes):
+        self.buffer += data
+
+        if len(self.buffer) < self.HEADER_LENGTH:
+            return
+
+        self.__cancel_timer()
+
+        pstrlen, pstr, info_hash = struct.unpack_from('>B19s8x20s', self.buffer)
+        torrent = self.session.torrents.get(info_hash)
+
+        if pstrlen != 19 or pstr != b'BitTorrent protocol' or torrent is None:
+            self.transport.loseConnection()
+            return
+
+        protocol = torrent.factory.buildProtocol(self.transport.getPeer())
+
+        # torrent is full
+        if protocol is None:
+            self.transport.loseConnection()
+            return
+
+        # everything from here on goes straight to the torrent's protocol
+        self.transport.protocol = protocol
+        protocol.makeConnection(self.transport)
+
+        if not self.transport.disconnecting:
+            protocol.dataReceived(bytes(self.buffer))
+
+class SessionFactory(Factory):
+    def __init__(self, session):
+        self.session = session
+
+    def buildProtocol(self, addr):
+        # turned away straight away if the whole session is full
+        if not self.session.budget.available():
+            return None
+
+        return HandshakeRouter(self.session)
+
+class Session:
+    # worker threads doing disk I/O, shared by every torrent
+    DISK_THREADS = 4
+
+    # bytes of pieces cached for uploading, across every torrent
+    CACHE_SIZE = 256 * 2**20
+
+    def __init__(self,
+                 directory: str = None,
+                 port: int = 6881,
+                 max_connections: int = 500,
+                 max_download_rate: int = 0,
+                 max_upload_rate: int = 0,
+                 disk_threads: int = DISK_THREADS,
+                 cache_size: int = CACHE_SIZE,
+                 metrics: MetricsRegistry = None,
+                 torrent_options: dict = None):
+        '''
+        runs any number of torrents in one process - they all share the
+        reactor, one listening port and peer id, one pool of disk threads
+        and piece cache, and the session wide connection and bandwidth limits
+
+        torrent_options are passed on to every torrent's PeerFactory
+        as keyword arguments (things like max_connections per torrent or
+        per peer rate limits), torrents keep seeding once they're done
+        unless told otherwise
+        '''
+
+        # where downloaded files go (downloads/ in the working directory by default)
+        self.directory = directory
+        self.port = port
+        self.peer_id = generate_peer_id()
+
+        # info hash -> Torrent
+        self.torrents = {}
+        # .torrent path -> modified time when it was last loaded
+        self.loaded_paths = {}
+
+        self.budget = ConnectionBudget(max_connections)
+        self.download_bucket = TokenBucket(max_download_rate)
+        self.upload_bucket = TokenBucket(max_upload_rate)
+
+        self.disk_pool = ThreadPool(0, disk_threads, 'disk')
+        self.disk_cache = PieceCache(cache_size)
+
+        self.torrent_options = dict(torrent_options or {})
+        self.torrent_options.setdefault('keep_seeding', True)
+        self.torrent_options.setdefault('show_progress', False)
+        self.torrent_options['exit_when_done'] = False
+
+        self.listener = None
+
+        self.metrics = metrics or MetricsRegistry()
+        self.__register_metrics()
+
+    def __register_metrics(self):
+        factories = lambda: [torrent.factory for torrent in self.torrents.values()]
+        protocols = lambda: [protocol for factory in factories() for protocol in factory.protocols]
+
+        metrics = self.metrics
+
+        metrics.gauge('torrents', 'Torrents in the session', lambda: len(self.torrents))
+        metrics.gauge('torrents_completed', 'Torrents with every piece verified',
+                      lambda: sum(1 for factory in factories() if factory.completed_pieces.all()))
+        metrics.gauge('connections', 'Open connections and dials in progress, across torrents',
+                      lambda: self.budget.used)
+        metrics.gauge('download_rate_bytes', 'Bytes per second received from all peers',
+                      lambda: sum(protocol.download_meter.get_rate() for protocol in protocols()))
+        metrics.gauge('upload_rate_bytes', 'Bytes per second sent to all peers',
+                      lambda: sum(protocol.upload_meter.get_rate() for protocol in protocols()))
+        metrics.gauge('downloaded_bytes', 'Block data received',
+                      lambda: sum(factory.downloaded for factory in factories()))
+        metrics.gauge('uploaded_bytes', 'Block data sent',
+                      lambda: sum(factory.uploaded for factory in factories()))
+        metrics.gauge('disk_write_queue_depth', 'Piece writes waiting on the disk',
+                      lambda: sum(factory.disk.write_queue_depth() for factory in factories()))
+        metrics.gauge('disk_read_queue_depth', 'Upload reads waiting on the disk',
+                      lambda: sum(factory.disk.read_queue_depth() for factory in factories()))
+        metrics.gauge('disk_cache_hit_ratio', 'Fraction of upload reads served from the piece cache',
+                      self.cache_hit_rate)
+        metrics.gauge('disk_cache_bytes', 'Bytes of pieces held in the cache',
+                      lambda: self.disk_cache.size)
+
+    def cache_hit_rate(self) -> float:
+        hits = sum(torrent.factory.disk.cache_hits for torrent in self.torrents.values())
+        misses = sum(torrent.factory.disk.cache_misses for torrent in self.torrents.values())
+
+        if hits + misses == 0:
+            return 0.0
+
+        return hits / (hits + misses)
+
+    def start(self):
+        self.listener = reactor.listenTCP(self.port, SessionFactory(self))
+
+        reactor.callWhenRunning(self.disk_pool.start)
+        # torrents wait for their writes before shutdown, so the pool is done by now
+        reactor.addSystemEventTrigger('during', 'shutdown', self.disk_pool.stop)
+
+    def add_torrent(self, path: str) -> Torrent:
+        '''
+        start downloading (or seeding) a torrent, if it's already
+        in the session the existing one is returned
+        '''
+
+        meta_info = MetaInfo(path)
+        meta_info.parse_file()
+
+        if meta_info.info_hash in self.torrents:
+            return self.torrents[meta_info.info_hash]
+
+        tracker = Tracker(meta_info, peer_id=self.peer_id)
+        tracker.port = self.port
+
+        factory = PeerFactory(tracker.peers, meta_info, self.peer_id,
+                              global_download=self.download_bucket,
+                              global_upload=self.upload_bucket,
+                              directory=self.directory,
+                              disk_pool=self.disk_pool,
+                              disk_cache=self.disk_cache,
+                              connection_budget=self.budget,
+                              **self.torrent_options)
+
+        torrent = Torrent(meta_info, tracker, factory, path)
+        self.torrents[meta_info.info_hash] = torrent
+
+        factory.finished.addCallback(self.__finished, torrent)
+
+        # trackers hear about us once we know which pieces are on disk
+        factory.ready.addCallback(lambda _: reactor.callWhenRunning(self.__start_torrent, torrent))
+
+        return torrent
+
+    def __start_torrent(self, torrent: Torrent):
+        # removed before the reactor got going, or its files couldn't be opened
+        if torrent.info_hash not in self.torrents or torrent.factory.stopped:
+            return
+
+        d = torrent.tracker.start(torrent.factory)
+        d.addErrback(self.__tracker_error, torrent)
+
+    def __tracker_error(self, failure, torrent: Torrent):
+        # trackers are retried in the background, so keep going
+        print("\nCouldn't get any peers for %s: %s (retrying)" % (torrent.name, failure.getErrorMessage()))
+
+    def __finished(self, _, torrent: Torrent):
+        print("\nFinished downloading %s" % torrent.name)
+
+    def remove_torrent(self, info_hash: bytes) -> defer.Deferred:
+        '''
+        disconnect a torrent's peers and tell its trackers we're leaving,
+        fires once its writes have landed and its progress is saved
+        '''
+
+        torrent = self.torrents.pop(info_hash)
+        self.loaded_paths.pop(torrent.path, None)
+
+        return defer.DeferredList([torrent.tracker.stop(), torrent.factory.stop()], consumeErrors=True)
+
+    def load_directory(self, directory: str) -> list:
+        '''
+        add every .torrent file in directory that hasn't been loaded yet
+        (or has changed since), safe to call over and over to pick up new files
+
+        returns the torrents that were added
+        '''
+
+        added = []
+
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.torrent'):
+                continue
+
+            path = os.path.join(directory, name)
+
+            try:
+                modified = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+
+            if self.loaded_paths.get(path) == modified:
+                continue
+
+            # not tried again until the file changes
+            self.loaded_paths[path] = modified
+
+            try:
+                added.append(self.add_torrent(path))
+            except (OSError, KeyError, ValueError, TypeError, EOFError) as error:
+                print("\nCouldn't load %s: %s" % (name, error))
+
+        return added
+
+    def status(self) -> str:
+        completed = sum(1 for torrent in self.torrents.values() if torrent.factory.completed_pieces.all())
+        download_rate = 0.0
+        upload_rate = 0.0
+
+        for torrent in self.torrents.values():
+            for protocol in torrent.factory.protocols:
+                download_rate += protocol.download_meter.get_rate()
+                upload_rate += protocol.upload_meter.get_rate()
+
+        return ("%d torrents (%d complete), %d connections, %.1f KiB/s down, %.1f KiB/s up"
+                % (len(self.torrents), completed, self.budget.used, download_rate / 1024, upload_rate / 1024))
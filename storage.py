@@ -0,0 +1,214 @@
+from metainfo import MetaInfo
+import threading
+import mmap
+import os
+
+# most buffers a single vectored write can take (the limit on Linux and macOS)
+IOV_MAX = 1024
+
+class Storage:
+    def __init__(self, meta_info: MetaInfo, directory: str = None):
+        '''
+        maps the torrent's byte stream onto the files it's made of
+        so every verified piece can be written to disk at its offset
+        as soon as it completes, rather than holding the whole torrent
+        in memory until the end
+
+        docs on how pieces are laid out across files
+        https://wiki.theory.org/BitTorrentSpecification#Info_in_Multiple_File_Mode
+
+        everything here blocks - it's only called from the disk
+        scheduler's worker threads (and when closing)
+        '''
+
+        self.meta_info = meta_info
+        self.piece_length = meta_info.piece_length
+        self.length = meta_info.length
+        self.directory = directory or os.path.join(os.getcwd(), 'downloads')
+
+        # (path, offset within torrent, length) for every file
+        self.files = []
+        self.fds = []
+
+        # read-only maps used to serve blocks to other peers
+        self.maps = []
+
+        # only needed when the platform has no positional writes
+        self.lock = threading.Lock()
+
+        if meta_info.multi_files:
+            offset = 0
+
+            for file in meta_info.files:
+                path = os.path.join(self.directory, *file['path'])
+                self.files.append((path, offset, file['length']))
+                offset += file['length']
+        else:
+            path = os.path.join(self.directory, meta_info.name)
+            self.files.append((path, 0, meta_info.length))
+
+    def open(self):
+        '''
+        create every file at its final size up front so pieces
+        can be written in whatever order they arrive
+        '''
+
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+
+        for path, _, length in self.files:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            fd = os.open(path, flags, 0o666)
+            self.__preallocate(fd, length)
+            self.fds.append(fd)
+
+            # empty files can't be mapped (and have nothing to read)
+            if length > 0:
+                self.maps.append(mmap.mmap(fd, length, access=mmap.ACCESS_READ))
+            else:
+                self.maps.append(None)
+
+    def __preallocate(self, fd: int, length: int):
+        size = os.fstat(fd).st_size
+
+        if size > length:
+            os.ftruncate(fd, length)
+        elif size < length:
+            try:
+                # reserves the blocks so later writes can't fail for space
+                os.posix_fallocate(fd, 0, length)
+            except (AttributeError, OSError):
+                # not supported on this platform/filesystem - sparse file instead
+                os.ftruncate(fd, length)
+
+    def get_spans(self, start: int, length: int) -> list:
+        '''
+        figure out which files a range of the torrent overlaps with
+
+        returns a list of (file index, offset in file, start in range, end in range)
+        '''
+
+        end = start + length
+        spans = []
+
+        for file_index, (_, file_start, file_len) in enumerate(self.files):
+            file_end = file_start + file_len
+
+            if file_end <= start or file_len == 0:
+                continue
+            if file_start >= end:
+                break
+
+            span_start = max(start, file_start)
+            span_end = min(end, file_end)
+
+            spans.append((file_index,
+                          span_start - file_start,
+                          span_start - start,
+                          span_end - start))
+
+        return spans
+
+    def write(self, offset: int, buffers: list) -> set:
+        '''
+        write buffers back to back starting at offset in the torrent,
+        each file gets a single vectored write for its part rather than
+        one write per buffer
+
+        returns the indices of the files that were written to
+        '''
+
+        views = [memoryview(buffer) for buffer in buffers]
+        length = sum(len(view) for view in views)
+        written = set()
+
+        for file_index, file_offset, start, end in self.get_spans(offset, length):
+            self.__pwritev(self.fds[file_index], self.__slice(views, start, end), file_offset)
+            written.add(file_index)
+
+        return written
+
+    def __slice(self, views: list, start: int, end: int) -> list:
+        # the parts of views that cover [start, end) of them laid end to end
+        sliced = []
+        position = 0
+
+        for view in views:
+            view_end = position + len(view)
+
+            if view_end > start and position < end:
+                sliced.append(view[max(start - position, 0):min(end, view_end) - position])
+
+            position = view_end
+
+        return sliced
+
+    def __pwritev(self, fd: int, views: list, offset: int):
+        if not hasattr(os, 'pwritev'):
+            for view in views:
+                self.__pwrite(fd, view, offset)
+                offset += len(view)
+
+            return
+
+        # os.pwritev can write less than requested, keep going until it's all out
+        while views:
+            written = os.pwritev(fd, views[:IOV_MAX], offset)
+            offset += written
+
+            while written > 0:
+                if written >= len(views[0]):
+                    written -= len(views[0])
+                    views.pop(0)
+                else:
+                    views[0] = views[0][written:]
+                    written = 0
+
+    def __pwrite(self, fd: int, data: memoryview, offset: int):
+        # os.pwrite can write less than requested, keep going until it's all out
+        while len(data) > 0:
+            if hasattr(os, 'pwrite'):
+                written = os.pwrite(fd, data, offset)
+            else:
+                with self.lock:
+                    os.lseek(fd, offset, os.SEEK_SET)
+                    written = os.write(fd, data)
+
+            data = data[written:]
+            offset += written
+
+    def read(self, offset: int, length: int) -> bytes:
+        '''
+        read straight out of the mapped files (page faults
+        happen on whichever thread calls this)
+        '''
+
+        spans = self.get_spans(offset, length)
+
+        # usual case - range sits inside one file, a single copy out of the map
+        if len(spans) == 1:
+            file_index, file_offset, _, _ = spans[0]
+            return self.maps[file_index][file_offset:file_offset + length]
+
+        return b''.join(self.maps[file_index][file_offset:file_offset + end - start]
+                        for file_index, file_offset, start, end in spans)
+
+    def sync(self, file_indices):
+        '''
+        flush the given files' written data all the way to the disk
+        '''
+
+        for file_index in file_indices:
+            if file_index < len(self.fds):
+                os.fsync(self.fds[file_index])
+
+    def close(self):
+        for file_map in self.maps:
+            if file_map is not None:
+                file_map.close()
+
+        for fd in self.fds:
+            os.close(fd)
+
+        self.maps = []
+        self.fds = []
@@ -1,12 +1,55 @@
 from metainfo import MetaInfo
 from connections.http_request import HttpRequest
-from connections.udp_request import UdpRequest
+from connections.udp_request import UdpTrackerClient
+from models.tracker_tier import TrackerTier
+from metrics import MetricsRegistry
 from utils.bencoding import Decoder
+from twisted.internet import reactor, threads, defer, task
+import urllib.parse
 import random
 import socket
+import time
+
+def generate_peer_id() -> bytes:
+    '''
+    docs for logic behind peer_id 
+    https://wiki.theory.org/BitTorrentSpecification#peer_id
+
+    this is for creating the client's (our) peer ID that acts as a 
+    form of identification
+    '''
+
+    return ('-NA0004-' + ''.join(
+        str(random.randint(0, 9)) for i in range(12))
+            ).encode()
 
 class Tracker:
-    def __init__(self, meta_info: MetaInfo):
+    # event values used by UDP trackers
+    EVENTS = {'' : 0, 'completed' : 1, 'started' : 2, 'stopped' : 3}
+
+    # seconds before retrying a tier where every tracker failed (doubles each time)
+    RETRY_INTERVAL = 60
+    MAX_RETRY_INTERVAL = 1800
+
+    # UDP retries (n in 15 * 2^n) when the tier has other trackers to fall
+    # back on - about 105 seconds rather than the two hours of the full count
+    FAILOVER_RETRIES = 2
+
+    # used when a tracker doesn't give a min interval
+    DEFAULT_MIN_INTERVAL = 300
+
+    # seconds between checks for whether we're running low on peers
+    PEER_CHECK_INTERVAL = 60
+
+    # seconds to wait on 'stopped' announces at shutdown
+    STOP_TIMEOUT = 5
+
+    def __init__(self,
+                 meta_info: MetaInfo,
+                 udp_client: UdpTrackerClient = None,
+                 http_client: HttpRequest = None,
+                 metrics: MetricsRegistry = None,
+                 peer_id: bytes = None):
         '''
         docs for understanding tracker request params
         https://wiki.theory.org/BitTorrentSpecification#Tracker_HTTP.2FHTTPS_Protocol
@@ -14,30 +57,72 @@ class Tracker:
 
         self.meta_info = meta_info
         self.info_hash = self.meta_info.info_hash
-        self.peer_id = self.__generate_peer_id()
+
+        metrics = metrics or MetricsRegistry()
+        self.announce_timer = metrics.timer('tracker_announce_seconds', 'Time for a tracker to answer an announce')
+        self.announce_failures = metrics.counter('tracker_announce_failures', 'Announces that failed or timed out')
+        # a session shares one peer id between all of its torrents
+        self.peer_id = peer_id or generate_peer_id()
+
+        # one UDP socket is shared by every torrent unless told otherwise
+        self.udp_client = udp_client or UdpTrackerClient.get_shared()
+        # same goes for pooled HTTP connections
+        self.http_client = http_client or HttpRequest.get_shared()
         self.port = 6881
         self.uploaded = 0
         self.downloaded = 0
+        self.left = self.meta_info.length
+
+        # PeerFactory whose stats get reported
+        self.factory = None
+        self.on_peers = None
+        self.stopped = False
+        self.peer_check = task.LoopingCall(self.__check_peers)
 
-        self.peers = []
+        # (host, port) -> Peer for every peer any tracker has
+        # handed over, so the same peer isn't added twice
+        self.peers = {}
         self.interval = None
 
-    def __generate_peer_id(self) -> bytes:
+        self.tiers = self.__get_tiers()
+
+    def __get_tiers(self) -> list:
         '''
-        docs for logic behind peer_id 
-        https://wiki.theory.org/BitTorrentSpecification#peer_id
+        docs for multitracker metadata extension
+        https://www.bittorrent.org/beps/bep_0012.html
 
-        this is for creating the client's (our) peer ID that acts as a 
-        form of identification
+        trackers within each tier are shuffled, and the
+        announce url is ignored if there's an announce list
         '''
 
-        return ('-NA0004-' + ''.join(
-            str(random.randint(0, 9)) for i in range(12))
-                ).encode()
-    
-    def http_request(self):
+        if not hasattr(self.meta_info, 'announce_list'):
+            return [TrackerTier([self.meta_info.announce_url])]
+
+        tiers = []
+
+        for tier in self.meta_info.announce_list:
+            urls = [urllib.parse.urlparse(url.decode()) for url in tier]
+            random.shuffle(urls)
+            tiers.append(TrackerTier(urls))
+
+        return tiers
+
+    def __update_stats(self):
+        '''
+        report how the download is actually going
+        '''
+
+        if self.factory is None:
+            return
+
+        self.uploaded = self.factory.uploaded
+        self.downloaded = self.factory.downloaded
+        self.left = self.factory.bytes_left()
+
+    def http_request(self, announce_url: tuple, event: str) -> defer.Deferred:
         '''
-        used for HTTP(S) trackers
+        used for HTTP(S) trackers - the request itself is blocking,
+        so it runs on the reactor's thread pool
         '''
 
         request_param = {'info_hash' : self.info_hash,
@@ -45,84 +130,296 @@ class Tracker:
                          'port' : self.port,
                          'uploaded' : self.uploaded,
                          'downloaded' : self.downloaded,
-                         'left' : self.meta_info.length,
-                         'compact' : 1,
-                         'event' : 'started'
+                         'left' : self.left,
+                         'compact' : 1
                         }
-        
-        request = HttpRequest()
 
-        response_content = request.format_request(request_param, 
-                                                  self.meta_info.announce_url)
+        # regular announces leave the event out
+        if event:
+            request_param['event'] = event
         
-        decoded_response = Decoder(response_content).decode()
+        d = threads.deferToThread(self.http_client.format_request, request_param, announce_url)
+        d.addCallback(lambda response_content: Decoder(response_content).decode())
+
+        # obtain list of peers and intervals
+        d.addCallback(self.http_client.parse_request)
 
-        # obtain list of peers and interval - the 2 pieces of info we need
-        peer_list, self.interval = request.parse_request(decoded_response)
+        return d
 
-        self.peers.extend(peer_list)
+    def http_scrape(self, announce_url: tuple, info_hashes: list) -> defer.Deferred:
+        d = threads.deferToThread(self.http_client.format_scrape, info_hashes, announce_url)
+        d.addCallback(lambda response_content: Decoder(response_content).decode())
+        d.addCallback(self.http_client.parse_scrape)
 
-    def udp_request(self):
+        return d
+
+    def udp_request(self, announce_url: tuple, event: str, max_retries: int = None) -> defer.Deferred:
         '''
         used for UDP trackers - more efficient than HTTP due
         to decreased # of packets and packet size
-
-        docs for socket initiation
-        https://wiki.python.org/moin/UdpCommunication
-        https://docs.python.org/3/library/socket.html#socket-timeouts
         '''
 
-        # SOCK_DGRAM is used for UDP connections
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.settimeout(5)
-
-        # need IP address (IPv4) and port to send packet
-        ip_address = socket.gethostbyname(self.meta_info.announce_url.hostname)
-        port = self.meta_info.announce_url.port
-
-        address = (ip_address, port)
-
-        connection = UdpRequest()
-
-        connect_response = connection.send_request(sock, 
-                                                   address, 
-                                                   connection.create_packet_conn())
-        
-        decoded_resp = connection.parse_connection(connect_response)
-
         request_param = {
-            'connection_id' : decoded_resp['connection_id'],
-            'action' : 1, # 1 for announce
-            'transaction_id' : decoded_resp['transaction_id'],
             'info_hash' : self.info_hash,
             'peer_id' : self.peer_id,
             'downloaded' : self.downloaded,
-            'left' : self.meta_info.length,
+            'left' : self.left,
             'uploaded' : self.uploaded,
-            'event' : 0, # 0 for none
+            'event' : self.EVENTS[event],
             'IP address' : 0, # default 
             'num_want' : -1, # default
             'port' : self.port
         }
 
-        ann_response = connection.send_request(sock, 
-                                               address, 
-                                               connection.create_packet_ann(request_param))
-        
-        decoded_ann = connection.parse_announce(ann_response)
+        d = self.resolve(announce_url)
+        d.addCallback(self.udp_client.announce, request_param, max_retries)
+
+        # UDP trackers don't have a min interval
+        d.addCallback(lambda decoded_ann: (decoded_ann['peers'], decoded_ann['interval'], None))
+
+        return d
+
+    def resolve(self, announce_url: tuple) -> defer.Deferred:
+        '''
+        look the tracker up without blocking the reactor, fires with
+        (ip, port) - getaddrinfo is used as it handles IPv6 too
+        '''
+
+        d = threads.deferToThread(socket.getaddrinfo, announce_url.hostname,
+                                  announce_url.port, 0, socket.SOCK_DGRAM)
+        d.addCallback(lambda addresses: addresses[0][4][:2])
+
+        return d
+
+    def udp_scrape(self, announce_url: tuple, info_hashes: list) -> defer.Deferred:
+        d = self.resolve(announce_url)
+        d.addCallback(self.udp_client.scrape, info_hashes)
+
+        return d
+
+    def scrape(self, announce_url: tuple, info_hashes: list = None) -> defer.Deferred:
+        '''
+        ask a tracker how many seeds and leechers it has for any number of
+        torrents at once (just ours by default), fires with
+        info hash -> {'complete', 'downloaded', 'incomplete'}
+        '''
+
+        info_hashes = info_hashes or [self.info_hash]
+        scheme = announce_url.scheme
 
-        # necessary information is now successfully obtained
-        self.interval = decoded_ann['interval']
-        self.peers.extend(decoded_ann['peers'])
+        if scheme == 'http' or scheme == 'https':
+            return self.http_scrape(announce_url, info_hashes)
+        elif scheme == 'udp':
+            return self.udp_scrape(announce_url, info_hashes)
+
+        return defer.fail(Exception("Invalid scheme found in announce contents"))
+
+    def announce(self, announce_url: tuple, event: str, max_retries: int = None) -> defer.Deferred:
+        '''
+        fires with (peers, interval, min interval), max_retries
+        only applies to UDP trackers
+        '''
 
-    def fetch_peers(self):
-        scheme = self.meta_info.announce_url.scheme
+        self.__update_stats()
+
+        scheme = announce_url.scheme
 
         # handle http/https/udp trackers
         if scheme == 'http' or scheme == 'https':
-            self.http_request()
+            d = self.http_request(announce_url, event)
         elif scheme == 'udp':
-            self.udp_request()
+            d = self.udp_request(announce_url, event, max_retries)
         else:
-            raise Exception("Invalid scheme found in announce contents")
\ No newline at end of file
+            return defer.fail(Exception("Invalid scheme found in announce contents"))
+
+        d.addCallbacks(self.__announce_done, self.__announce_failed,
+                       callbackArgs=(time.perf_counter(),))
+
+        return d
+
+    def __announce_done(self, response: tuple, start: float) -> tuple:
+        self.announce_timer.observe(time.perf_counter() - start)
+
+        return response
+
+    def __announce_failed(self, failure):
+        self.announce_failures.inc()
+
+        return failure
+
+    def add_peers(self, peers: list) -> list:
+        '''
+        merge in peers from a tracker, returns our Peer for every one of
+        them (known peers keep their object, and with it their history)
+
+        peers we've seen before are handed on again, the connection
+        manager decides whether they're worth another try
+        '''
+
+        return [self.peers.setdefault(peer.address, peer) for peer in peers]
+
+    def __announce_tier(self, tier: TrackerTier, event: str, position: int = 0) -> defer.Deferred:
+        '''
+        trackers within a tier are tried one after the other
+        until one of them answers
+        '''
+
+        if position == 0:
+            tier.last_announce = time.monotonic()
+
+        if event in ('started', 'completed'):
+            tier.event = event
+
+        # a dead UDP tracker shouldn't hold up the rest of its tier
+        max_retries = self.FAILOVER_RETRIES if len(tier.trackers) > 1 else None
+
+        d = self.announce(tier.trackers[position], event, max_retries)
+        d.addCallbacks(self.__tier_answered, self.__tier_failed,
+                       callbackArgs=(tier, event, position),
+                       errbackArgs=(tier, event, position))
+
+        return d
+
+    def __tier_answered(self, response: tuple, tier: TrackerTier, event: str, position: int):
+        peer_list, interval, min_interval = response
+
+        # tracker that answered goes to the front of its tier
+        tier.trackers.insert(0, tier.trackers.pop(position))
+
+        tier.interval = interval
+        tier.min_interval = min_interval
+        tier.failures = 0
+        tier.answered = True
+
+        if event == tier.event:
+            tier.event = ''
+
+        if self.interval is None or interval < self.interval:
+            self.interval = interval
+
+        if event != 'stopped':
+            self.__schedule(tier, interval)
+
+        peers = self.add_peers(peer_list)
+
+        if self.on_peers is not None and len(peers) > 0:
+            self.on_peers(peers)
+
+    def __tier_failed(self, failure, tier: TrackerTier, event: str, position: int):
+        if position + 1 < len(tier.trackers):
+            return self.__announce_tier(tier, event, position + 1)
+
+        # every tracker in the tier failed, back off before trying again
+        if event != 'stopped':
+            tier.failures += 1
+            self.__schedule(tier, min(self.RETRY_INTERVAL * 2 ** (tier.failures - 1), self.MAX_RETRY_INTERVAL))
+
+        return failure
+
+    def __schedule(self, tier: TrackerTier, delay: int):
+        if self.stopped:
+            return
+
+        if tier.timer is not None and tier.timer.active():
+            tier.timer.cancel()
+
+        tier.timer = reactor.callLater(delay, self.__reannounce, tier)
+
+    def __reannounce(self, tier: TrackerTier):
+        tier.timer = None
+
+        # errors are already handled by rescheduling, a 'started' or
+        # 'completed' that didn't get through is sent again
+        self.__announce_tier(tier, tier.event).addErrback(lambda _: None)
+
+    def fetch_peers(self, on_peers=None, event: str = 'started') -> defer.Deferred:
+        '''
+        announce to every tier at the same time, on_peers is called
+        with the new peers as soon as each tracker answers
+
+        fires once every tier is done, fails if none of them answered
+        '''
+
+        self.on_peers = on_peers
+
+        d = defer.DeferredList([self.__announce_tier(tier, event) for tier in self.tiers],
+                               consumeErrors=True)
+        d.addCallback(self.__fetch_done)
+
+        return d
+
+    def __fetch_done(self, results: list):
+        if not any(success for success, _ in results):
+            raise Exception("None of the trackers could be reached")
+
+    def start(self, factory) -> defer.Deferred:
+        '''
+        keep announcing for as long as the download runs - every tier
+        re-announces on its own interval, reporting real transfer stats,
+        and every new peer goes straight into the factory's connection pool
+
+        fires once the first round of announces is done
+        '''
+
+        self.factory = factory
+
+        # tracker is told when the download finishes and when we leave
+        factory.finished.addCallback(self.__download_finished)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+        self.peer_check.start(self.PEER_CHECK_INTERVAL, now=False)
+
+        return self.fetch_peers(factory.connection_manager.add_peers)
+
+    def __download_finished(self, _):
+        for tier in self.tiers:
+            if tier.answered:
+                self.__announce_tier(tier, 'completed').addErrback(lambda _: None)
+
+    def __check_peers(self):
+        '''
+        ask for more peers early when we're running low,
+        as long as the tracker's min interval allows it
+        '''
+
+        if not self.factory.connection_manager.needs_peers():
+            return
+
+        now = time.monotonic()
+
+        for tier in self.tiers:
+            if tier.timer is None or tier.last_announce is None:
+                continue
+
+            min_interval = tier.min_interval or self.DEFAULT_MIN_INTERVAL
+
+            if now - tier.last_announce >= min_interval:
+                tier.timer.cancel()
+                self.__reannounce(tier)
+
+    def stop(self) -> defer.Deferred:
+        '''
+        let trackers know we're leaving, without holding up
+        shutdown for more than a few seconds
+        '''
+
+        # already stopped (removed from a session before shutdown)
+        if self.stopped:
+            return defer.succeed(None)
+
+        self.stopped = True
+
+        if self.peer_check.running:
+            self.peer_check.stop()
+
+        for tier in self.tiers:
+            if tier.timer is not None and tier.timer.active():
+                tier.timer.cancel()
+
+        d = defer.DeferredList([self.__announce_tier(tier, 'stopped')
+                                for tier in self.tiers if tier.answered],
+                               consumeErrors=True)
+        d.addTimeout(self.STOP_TIMEOUT, reactor)
+        d.addErrback(lambda _: None)
+
+        return d
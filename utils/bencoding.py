@@ -1,5 +1,3 @@
-from collections import OrderedDict
-
 STR_START = b'0123456789'
 INT_START = b'i'
 LIST_START = b'l'
@@ -7,165 +5,207 @@ DICT_START = b'd'
 TYPE_END = b'e'
 SIZE_DELIMITER = b':'
 
+# same markers as ints, which is what indexing bytes gives back
+INT_BYTE = INT_START[0]
+LIST_BYTE = LIST_START[0]
+DICT_BYTE = DICT_START[0]
+END_BYTE = TYPE_END[0]
+ZERO_BYTE = STR_START[0]
+NINE_BYTE = STR_START[-1]
+MINUS_BYTE = b'-'[0]
+
 class Decoder:
-    def __init__(self, value: bytes):
+    def __init__(self, value: bytes, strict: bool = False):
+        '''
+        docs for the format
+        https://www.bittorrent.org/beps/bep_0003.html#bencoding
+
+        any bytes-like value can be passed in (anything other than bytes,
+        like a memoryview, is copied once so slices come out as bytes),
+        dictionaries come back as plain dicts in the order they were written
+
+        strict mode rejects anything the spec doesn't allow even though it
+        can still be read - dict keys that aren't sorted (or repeat), leading
+        zeros and -0 in numbers, and data left over after the value
+        '''
+
+        if type(value) is not bytes:
+            value = bytes(value)
+
         self.__value = value
         self.__index = 0
         self.__MAX_INDEX = len(value)
+        self.strict = strict
+
+        # key -> (start, end) byte range of every value in the top level
+        # dict, so things like the info hash can be taken over the original bytes
+        self.spans = {}
 
     def decode(self):
         '''
-        Depending on value's starting byte, return appropriate decoded message
+        decode the value at the current position, nested lists and
+        dicts are handled with a stack rather than recursion so deep
+        nesting can't blow up the interpreter stack
         '''
 
-        # should never reach end of file without decoding ending
-        if self.__current_byte() is None:
-            raise EOFError("Reached end of error before decoding is completed.")
-        
-        if self.__current_byte() == INT_START:
-            return self.__decode_int()
-        elif self.__current_byte() == LIST_START:
-            return self.__decode_list()
-        elif self.__current_byte() == DICT_START:
-            return self.__decode_dict()
-        elif self.__current_byte() in STR_START:
-            return self.__decode_string()
-        elif self.__current_byte() == TYPE_END:
-            return None
-
-        raise TypeError("Invalid value passed - Value needs to be of type 'bytes'")
-    
-    def __current_byte(self) -> bytes:
-        # use slicing rather than indexing to return byte object rather than int
-        if self.__index + 1 >= self.__MAX_INDEX:
-            return None
-        
-        return self.__value[self.__index:self.__index + 1]
-
-    def __update_index(self, increment: int) -> None:
-        '''
-        Update index of bytes by given param
-        '''
+        value = self.__value
+        index = self.__index
+        end = self.__MAX_INDEX
+        strict = self.strict
 
-        self.__index+= increment
+        # lists/dicts that are still open, and the key waiting
+        # for a value in each of them (None for lists)
+        containers = []
+        keys = []
 
-    def __get_size(self) -> int:
-        '''
-        Determine the size of string/list
-        '''
+        # where the top level dict's current value starts
+        span_start = None
 
-        end_index = self.__value.find(SIZE_DELIMITER, self.__index)
-        size = int(self.__value[self.__index:end_index])
+        while True:
+            if index >= end:
+                raise EOFError("Reached end of data before decoding was completed.")
 
-        return size
-    
-    def __decode_string(self) -> str:
-        str_size = self.__get_size()
+            if span_start is None and len(containers) == 1 and keys[0] is not None:
+                span_start = index
 
-        self.__index = self.__value.find(SIZE_DELIMITER, self.__index) + 1
-        end_index = self.__index + str_size
+            byte = value[index]
 
-        decoded_bytes = self.__value[self.__index:end_index]
+            if ZERO_BYTE <= byte <= NINE_BYTE:
+                colon = value.find(SIZE_DELIMITER, index)
 
-        # update index to point at next item
-        self.__index = end_index
+                if colon == -1:
+                    raise EOFError("Reached end of data before decoding was completed.")
 
-        return decoded_bytes
-    
-    def __decode_int(self) -> int:
-        self.__update_index(1)
+                size_bytes = value[index:colon]
 
-        # end index is set to next occurance of integer terminator
-        end_index = self.__value.find(TYPE_END, self.__index)
-        decoded_bytes = self.__value[self.__index:end_index]
+                if not size_bytes.isdigit():
+                    raise ValueError("Invalid string length at byte %d" % index)
+                if strict and len(size_bytes) > 1 and size_bytes[0] == ZERO_BYTE:
+                    raise ValueError("String length with a leading zero at byte %d" % index)
 
-        # index is now set to next item in file
-        self.__index = end_index + 1
+                start = colon + 1
+                index = start + int(size_bytes)
 
-        return int(decoded_bytes)
+                if index > end:
+                    raise EOFError("Reached end of data before decoding was completed.")
 
-    def __decode_list(self) -> list:
-        list = []
+                item = value[start:index]
+            elif byte == INT_BYTE:
+                stop = value.find(TYPE_END, index + 1)
 
-        # remove the 'l' byte
-        self.__update_index(1)
+                if stop == -1:
+                    raise EOFError("Reached end of data before decoding was completed.")
 
-        while self.__value[self.__index:self.__index + 1] != TYPE_END:
-            list.append(self.decode())
+                digits = value[index + 1:stop]
 
-        # index now points to next item in file
-        self.__update_index(1)
+                # usual case - a plain non-negative number
+                if digits.isdigit() and not strict:
+                    item = int(digits)
+                else:
+                    item = self.__parse_int(digits, index)
 
-        return list
+                index = stop + 1
+            elif byte == LIST_BYTE or byte == DICT_BYTE:
+                containers.append([] if byte == LIST_BYTE else {})
+                keys.append(None)
+                index += 1
+                continue
+            elif byte == END_BYTE:
+                if len(containers) == 0:
+                    raise ValueError("Unexpected end marker at byte %d" % index)
+                if keys[-1] is not None:
+                    raise ValueError("Dict key without a value at byte %d" % index)
 
-    def __decode_dict(self) -> dict:
-        dict = OrderedDict()
+                item = containers.pop()
+                keys.pop()
+                index += 1
+            else:
+                raise TypeError("Invalid value passed - unexpected byte %r at %d" % (bytes([byte]), index))
 
-        # remove the 'd' byte
-        self.__update_index(1)
+            # top level value is done
+            if not containers:
+                if strict and index != end:
+                    raise ValueError("Data left over after decoding at byte %d" % index)
 
-        while self.__value[self.__index:self.__index + 1] != TYPE_END:
-            key = self.decode()
-            value = self.decode()
+                self.__index = index
+                return item
 
-            dict[key] = value
+            container = containers[-1]
 
-        # index now points to next item in file
-        self.__update_index(1)
+            if type(container) is list:
+                container.append(item)
+            elif keys[-1] is None:
+                if type(item) is not bytes:
+                    raise ValueError("Dict key isn't a string at byte %d" % index)
+                # keys have to be sorted, which also rules out repeats
+                if strict and len(container) > 0 and next(reversed(container)) >= item:
+                    raise ValueError("Dict keys out of order at byte %d" % index)
 
-        return dict
-    
-class Encoder:
-    #TODO: clean up code so that param is taken in constructor just like Decoder class,
-    #      consider using a var to keep track of curr_input
-    def encode(self, input):
-        '''
-        depending on given input, return bencoded object
-        '''
+                keys[-1] = item
+            else:
+                container[keys[-1]] = item
 
-        if type(input) is str:
-            return self.__encode_str(input)
-        elif type(input) is int:
-            return self.__encode_int(input)
-        elif type(input) is list:
-            return self.__encode_list(input)
-        elif type(input) is OrderedDict:
-            return self.__encode_dict(input)
-        elif type(input) is bytes:
-            return self.__encode_bytes(input)
-        else:
-            raise TypeError("Input is not valid to be bencoded.")
-        
+                if len(containers) == 1:
+                    self.spans[keys[0]] = (span_start, index)
+                    span_start = None
 
-    def __encode_str(self, input: str):
-        return bytes(str(len(input)) + ':' + input, 'utf-8')
+                keys[-1] = None
 
-    def __encode_int(self, input: int):
-        return bytes('i' + str(input) + 'e', 'utf-8')
+    def __parse_int(self, digits: bytes, index: int) -> int:
+        # int() would also take whitespace, '+' and '_', which aren't valid here
+        negative = len(digits) > 0 and digits[0] == MINUS_BYTE
+        magnitude = digits[1:] if negative else digits
 
-    def __encode_list(self, input: list):
-        res = bytearray('l', 'utf-8')
+        if not magnitude.isdigit():
+            raise ValueError("Invalid integer at byte %d" % index)
 
-        for item in input:
-            res.extend(self.encode(item))
+        if self.strict and ((len(magnitude) > 1 and magnitude[0] == ZERO_BYTE)
+                            or (negative and magnitude == b'0')):
+            raise ValueError("Integer with a leading zero or -0 at byte %d" % index)
 
-        res.extend(b'e')
+        return int(digits)
 
-        return bytes(res)
+class Encoder:
+    def encode(self, input) -> bytes:
+        '''
+        bencode input - everything is written into one buffer
+        rather than building up bytes at every level
 
-    def __encode_dict(self, input: OrderedDict):
-        res = bytearray('d', 'utf-8')
+        dict keys are written in the order they're stored, which
+        is expected to already be sorted (as the spec requires)
+        '''
 
-        for k, v in input.items():
-            res.extend(self.encode(k))
-            res.extend(self.encode(v))
-        res.extend(b'e')
+        buffer = bytearray()
+        self.__encode(input, buffer)
 
-        return bytes(res)
-    
-    def __encode_bytes(self, input: bytes):
-        res = bytearray(str(len(input)) + ':', 'utf-8')
+        return bytes(buffer)
 
-        res.extend(input)
+    def __encode(self, input, buffer: bytearray):
+        input_type = type(input)
 
-        return bytes(res)
+        if input_type is bytes or input_type is bytearray or input_type is memoryview:
+            buffer += b'%d:' % len(input)
+            buffer += input
+        elif input_type is str:
+            encoded = input.encode('utf-8')
+            buffer += b'%d:' % len(encoded)
+            buffer += encoded
+        elif input_type is int:
+            buffer += b'i%de' % input
+        elif input_type is list or input_type is tuple:
+            buffer += LIST_START
+
+            for item in input:
+                self.__encode(item, buffer)
+
+            buffer += TYPE_END
+        elif isinstance(input, dict):
+            buffer += DICT_START
+
+            for key, value in input.items():
+                self.__encode(key, buffer)
+                self.__encode(value, buffer)
+
+            buffer += TYPE_END
+        else:
+            raise TypeError("Input is not valid to be bencoded.")
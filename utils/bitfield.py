@@ -0,0 +1,145 @@
+# every byte with its bits flipped
+INVERTED = bytes(255 - byte for byte in range(256))
+
+# positions of the set bits in every possible byte (high bit first)
+SET_BITS = [tuple(bit for bit in range(8) if byte & (0x80 >> bit)) for byte in range(256)]
+
+class Bitfield:
+    def __init__(self, length: int, fill: bool = False):
+        '''
+        one bit per piece, laid out exactly like the wire bitfield
+        message (the high bit of the first byte is piece 0) so it
+        can be read from and written to peers without converting
+
+        the number of set bits is kept up to date as bits change,
+        so checking whether every piece is there never scans anything
+        '''
+
+        self.length = length
+        self.data = bytearray(b'\xff' if fill else b'\x00') * ((length + 7) // 8)
+        self.count = 0
+
+        if fill:
+            self.__clear_spare_bits()
+            self.count = length
+
+    @classmethod
+    def from_bytes(cls, data, length: int):
+        '''
+        build a bitfield from a wire message (or anything bytes-like),
+        bits past length are dropped and missing bytes count as zeros
+        '''
+
+        bitfield = cls(length)
+        size = len(bitfield.data)
+
+        with memoryview(data) as view:
+            view = view[:size]
+            bitfield.data[:len(view)] = view
+
+        bitfield.__clear_spare_bits()
+        bitfield.count = int.from_bytes(bitfield.data).bit_count()
+
+        return bitfield
+
+    def __clear_spare_bits(self):
+        spare = len(self.data) * 8 - self.length
+
+        if spare > 0:
+            self.data[-1] &= (0xff << spare) & 0xff
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index: int) -> bool:
+        if not 0 <= index < self.length:
+            raise IndexError('Bitfield index out of range')
+
+        return bool(self.data[index >> 3] & (0x80 >> (index & 7)))
+
+    def __setitem__(self, index: int, value: bool):
+        if value:
+            self.set(index)
+        else:
+            self.clear(index)
+
+    def set(self, index: int):
+        if not 0 <= index < self.length:
+            raise IndexError('Bitfield index out of range')
+
+        mask = 0x80 >> (index & 7)
+        byte = self.data[index >> 3]
+
+        if not byte & mask:
+            self.data[index >> 3] = byte | mask
+            self.count += 1
+
+    def clear(self, index: int):
+        if not 0 <= index < self.length:
+            raise IndexError('Bitfield index out of range')
+
+        mask = 0x80 >> (index & 7)
+        byte = self.data[index >> 3]
+
+        if byte & mask:
+            self.data[index >> 3] = byte & ~mask
+            self.count -= 1
+
+    def all(self) -> bool:
+        return self.count == self.length
+
+    def any(self) -> bool:
+        return self.count > 0
+
+    def indices(self):
+        '''
+        yield the index of every set bit, skipping over empty bytes
+        '''
+
+        for byte_index, byte in enumerate(self.data):
+            if byte == 0:
+                continue
+
+            base = byte_index << 3
+
+            for bit in SET_BITS[byte]:
+                yield base + bit
+
+    def tobytes(self) -> bytes:
+        return bytes(self.data)
+
+    def __combine(self, other, operation):
+        if other.length != self.length:
+            raise ValueError('Bitfields have different lengths')
+
+        size = len(self.data)
+        value = operation(int.from_bytes(self.data), int.from_bytes(other.data))
+
+        return Bitfield.from_bytes(value.to_bytes(size), self.length)
+
+    def __and__(self, other):
+        return self.__combine(other, lambda a, b: a & b)
+
+    def __or__(self, other):
+        return self.__combine(other, lambda a, b: a | b)
+
+    def __sub__(self, other):
+        '''
+        bits set here but not in other
+        '''
+
+        return self.__combine(other, lambda a, b: a & ~b)
+
+    def __invert__(self):
+        inverted = Bitfield(self.length)
+        inverted.data = bytearray(self.data.translate(INVERTED))
+        inverted.__clear_spare_bits()
+        inverted.count = self.length - self.count
+
+        return inverted
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Bitfield) and self.length == other.length and self.data == other.data
+
+    def __repr__(self) -> str:
+        return 'Bitfield(%d/%d)' % (self.count, self.length)
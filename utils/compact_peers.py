@@ -0,0 +1,30 @@
+from models.peer import Peer
+import socket
+import struct
+
+# (ip, port) for each peer, all big endian
+IPV4_PEER = struct.Struct('>4sH')
+IPV6_PEER = struct.Struct('>16sH')
+
+def parse_compact_peers(data: bytes, ipv6: bool = False) -> list:
+    '''
+    decode a compact peer list in one pass
+
+    docs for the compact format
+    https://www.bittorrent.org/beps/bep_0023.html (IPv4)
+    https://www.bittorrent.org/beps/bep_0007.html (IPv6)
+
+    - IP address is 4 bytes (16 for IPv6)
+    - port is 2 bytes
+
+    a trailing partial entry is ignored rather than failing the whole list
+    '''
+
+    entry = IPV6_PEER if ipv6 else IPV4_PEER
+    family = socket.AF_INET6 if ipv6 else socket.AF_INET
+    ntop = socket.inet_ntop
+
+    with memoryview(data) as view:
+        view = view[:len(view) - len(view) % entry.size]
+
+        return [Peer(ntop(family, ip), port) for ip, port in entry.iter_unpack(view)]
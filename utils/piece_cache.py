@@ -0,0 +1,46 @@
+from collections import OrderedDict
+
+class PieceCache:
+    def __init__(self, max_size: int):
+        '''
+        whole pieces kept in memory for uploading, the least recently
+        used ones are dropped once there's more than max_size bytes
+
+        keys are (info hash, piece index), so a session can share one
+        cache (and one memory cap) between all of its torrents
+        '''
+
+        self.max_size = max_size
+        self.size = 0
+        self.pieces = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.pieces)
+
+    def get(self, key: tuple):
+        data = self.pieces.get(key)
+
+        if data is not None:
+            self.pieces.move_to_end(key)
+
+        return data
+
+    def put(self, key: tuple, data):
+        # wouldn't fit even on its own
+        if len(data) > self.max_size:
+            return
+
+        self.discard(key)
+
+        self.pieces[key] = data
+        self.size += len(data)
+
+        while self.size > self.max_size:
+            _, evicted = self.pieces.popitem(last=False)
+            self.size -= len(evicted)
+
+    def discard(self, key: tuple):
+        data = self.pieces.pop(key, None)
+
+        if data is not None:
+            self.size -= len(data)
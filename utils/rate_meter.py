@@ -0,0 +1,51 @@
+import time
+
+class RateMeter:
+    # how often (in seconds) a new rate sample is taken
+    SAMPLE_TIME = 1.0
+
+    # weight given to the newest sample
+    SMOOTHING = 0.5
+
+    def __init__(self):
+        '''
+        keeps a smoothed bytes/second rate for a stream of transfers,
+        samples are taken about once a second and blended into an
+        exponential moving average
+        '''
+
+        self.total = 0
+        self.rate = 0.0
+        self.has_sample = False
+
+        self.__sample_start = time.monotonic()
+        self.__sample_bytes = 0
+
+    def update(self, amount: int):
+        self.total += amount
+        self.__sample_bytes += amount
+
+        now = time.monotonic()
+        elapsed = now - self.__sample_start
+
+        if elapsed >= self.SAMPLE_TIME:
+            sample = self.__sample_bytes / elapsed
+
+            if self.has_sample:
+                self.rate += (sample - self.rate) * self.SMOOTHING
+            else:
+                self.rate = sample
+                self.has_sample = True
+
+            self.__sample_start = now
+            self.__sample_bytes = 0
+
+    def get_rate(self) -> float:
+        '''
+        current rate, accounting for any time that's
+        passed without transfers since the last sample
+        '''
+
+        self.update(0)
+
+        return self.rate
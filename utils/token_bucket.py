@@ -0,0 +1,63 @@
+import time
+
+class TokenBucket:
+    # smallest burst allowed, so a single block can always get through
+    MIN_BURST = 2**15
+
+    def __init__(self, rate: float = 0, burst: float = None, parent = None):
+        '''
+        limits a stream of transfers to rate bytes/second (0 means no
+        limit), letting up to burst bytes through at once
+
+        buckets are chained through parent (peer -> torrent -> global),
+        anything taken from a bucket is taken from every bucket above it
+        too - tokens are topped up from the time that's passed whenever a
+        bucket is used, so there are no timers to run per bucket
+
+        transfers are never split up, a bucket just goes into debt and
+        whoever's using it waits until it's paid back
+        '''
+
+        self.parent = parent
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst or max(rate, self.MIN_BURST)
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+
+    def __refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def consume(self, amount: int):
+        now = time.monotonic()
+        bucket = self
+
+        while bucket is not None:
+            if bucket.rate > 0:
+                bucket.__refill(now)
+                bucket.tokens -= amount
+
+            bucket = bucket.parent
+
+    def get_delay(self) -> float:
+        '''
+        seconds until this bucket and every one above it is out of debt
+        '''
+
+        now = time.monotonic()
+        delay = 0.0
+        bucket = self
+
+        while bucket is not None:
+            if bucket.rate > 0:
+                bucket.__refill(now)
+
+                if bucket.tokens < 0:
+                    delay = max(delay, -bucket.tokens / bucket.rate)
+
+            bucket = bucket.parent
+
+        return delay
@@ -0,0 +1,61 @@
+from models.piece import Piece
+from twisted.internet import threads, defer
+import hashlib
+import time
+
+class PieceVerifier:
+    def __init__(self):
+        '''
+        checks completed pieces against their SHA1 hash from the
+        metainfo file on worker threads - hashlib releases the GIL
+        while hashing so the reactor keeps running in the meantime
+
+        also keeps track of how long hashing takes per piece
+        '''
+
+        self.num_verified = 0
+        self.num_failed = 0
+
+        # hashing latency (in seconds)
+        self.last_time = 0.0
+        self.max_time = 0.0
+        self.total_time = 0.0
+
+    def verify(self, piece: Piece, data) -> defer.Deferred:
+        '''
+        fires with True if the data matches the piece's hash
+        '''
+
+        d = threads.deferToThread(self.__hash, data)
+        d.addCallback(self.__check, piece)
+
+        return d
+
+    def __hash(self, data) -> tuple:
+        # runs on a worker thread
+        start = time.perf_counter()
+        digest = hashlib.sha1(data).digest()
+
+        return (digest, time.perf_counter() - start)
+
+    def __check(self, result: tuple, piece: Piece) -> bool:
+        digest, elapsed = result
+
+        self.last_time = elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.total_time += elapsed
+
+        if piece.is_equal_hash(digest):
+            self.num_verified += 1
+            return True
+
+        self.num_failed += 1
+        return False
+
+    def average_time(self) -> float:
+        num_hashed = self.num_verified + self.num_failed
+
+        if num_hashed == 0:
+            return 0.0
+
+        return self.total_time / num_hashed